@@ -0,0 +1,151 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+# Compares the asyncio client with the Twisted one on loopback, both running
+# on the same asyncio loop through Twisted's asyncioreactor. Python 3 only.
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from twisted.internet import asyncioreactor
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="asyncio vs Twisted client loopback benchmark.")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--qos", type=int, default=0, choices=(0, 1, 2))
+    parser.add_argument("--port", type=int, default=18833)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    asyncioreactor.install(loop)
+
+    from twisted.internet import reactor
+    from twisted.internet.defer import Deferred, ensureDeferred
+    from twisted.internet.task import deferLater
+
+    from modules.aio import AsyncMQTTClient
+    from modules.worker import MQTTWorker
+
+    config = {
+      "endpoint": "tcp:127.0.0.1:%d" %(args.port),
+      "version": "v311",
+      "username": None,
+      "app_key": None
+    }
+    payload = b"x" * args.payload_size
+
+    def client_config(clientId):
+        c = dict(config)
+        c["client_id"] = clientId
+        return c
+
+    async def bench_asyncio():
+        pub = AsyncMQTTClient(client_config("aio-pub"), loop)
+        sub = AsyncMQTTClient(client_config("aio-sub"), loop)
+        await pub.connect()
+        await sub.connect()
+        subscription = await sub.subscribe("bench/aio", qos=args.qos)
+
+        async def receive():
+            for i in range(args.messages):
+                await subscription.__anext__()
+
+        start = time.time()
+        receiver = loop.create_task(receive())
+        for i in range(args.messages):
+            await pub.publish("bench/aio", payload, args.qos)
+        await receiver
+        elapsed = time.time() - start
+
+        await pub.disconnect()
+        await sub.disconnect()
+        return elapsed
+
+    async def bench_twisted():
+        pub = MQTTWorker(reactor, client_config("tx-pub"))
+        sub = MQTTWorker(reactor, client_config("tx-sub"))
+        joined = []
+        for worker in (pub, sub):
+            d = Deferred()
+            worker.joined = lambda sessionPresent=False, d=d, w=worker: \
+                (MQTTWorker.joined(w, sessionPresent), d.callback(None))
+            joined.append(d)
+            worker.start()
+        for d in joined:
+            await d
+
+        done = Deferred()
+        received = [0]
+        def onMessage(message):
+            received[0] += 1
+            if received[0] == args.messages:
+                done.callback(None)
+        await sub.subscribe("bench/tx", onMessage, args.qos)
+
+        start = time.time()
+        for i in range(args.messages):
+            d = pub.protocol.publish("bench/tx", payload, args.qos)
+            if args.qos:
+                await d
+        await done
+        elapsed = time.time() - start
+
+        await pub.stopService()
+        await sub.stopService()
+        return elapsed
+
+    async def main():
+        # The broker runs apart so that only the clients are measured
+        broker = subprocess.Popen([sys.executable, "standin_broker.py",
+                                   "tcp:%d:interface=127.0.0.1" %(args.port)],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+        await deferLater(reactor, 1.0, lambda: None)
+
+        # Debug prints would dominate the measure
+        stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        # main() runs as a Twisted coroutine, asyncio awaitables must be wrapped
+        aio = await Deferred.fromFuture(loop.create_task(bench_asyncio()))
+        twisted = await ensureDeferred(bench_twisted())
+        sys.stdout = stdout
+        broker.terminate()
+
+        for name, elapsed in (("twisted", twisted), ("asyncio", aio)):
+            print("INFO: %-8s %d messages in %.3fs: %.0f msg/s"
+                  %(name, args.messages, elapsed, args.messages / elapsed))
+
+    def run():
+        d = ensureDeferred(main())
+        d.addErrback(lambda failure: failure.printTraceback())
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callWhenRunning(run)
+    reactor.run()
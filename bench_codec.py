@@ -0,0 +1,263 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+# Microbenchmarks of the MQTT codec (modules/messages.py): ns/op and bytes
+# allocated per op of the length / string helpers and of every packet pack
+# and unpack, across payload sizes and topic lengths. Results can be saved
+# as a baseline and later runs fail when a result regresses past the
+# threshold. Timings depend on the machine: keep one baseline per machine.
+
+import argparse
+import gc
+import json
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2: no allocation measurement
+    tracemalloc = None
+
+from modules.definitions import VERSION
+from modules.messages import encodeLength, decodeLength, encodeString, \
+                             decodeString, encodeTopic, \
+                             Connect, Connack, Publish, Puback, Pubrec, \
+                             Pubrel, Pubcomp, Subscribe, Suback, \
+                             Unsubscribe, Unsuback, Pingreq, Pingres, \
+                             Disconnect
+
+timer = getattr(time, "perf_counter", time.time)
+
+PAYLOAD_SIZES = (0, 64, 1024, 65536)
+TOPIC_LENGTHS = (8, 64, 256)
+LENGTHS = (0, 127, 16383, 2097151, 268435455)
+REFERENCE = "_reference"
+
+def makeTopic(length):
+    return ("t/" + "x" * length)[:length]
+
+def packCase(msg):
+    return msg.pack
+
+def unpackCase(cls, msg):
+    # Packets are parsed from slices of the protocol bytearray buffer
+    packet = bytearray(msg.pack())
+    return lambda: cls.unpack(packet)
+
+def cases():
+    """
+    Yields the benchmark names and the functions to time.
+    """
+    for value in LENGTHS:
+        encoded = bytearray(encodeLength(value))
+        yield "encodeLength/%d" %(value), lambda value=value: encodeLength(value)
+        yield "decodeLength/%d" %(value), lambda encoded=encoded: decodeLength(encoded)
+
+    for length in TOPIC_LENGTHS:
+        topic = makeTopic(length)
+        encoded = bytearray(encodeString(topic))
+        yield "encodeString/%d" %(length), lambda topic=topic: encodeString(topic)
+        yield "encodeTopic/%d" %(length), lambda topic=topic: encodeTopic(topic)
+        yield "decodeString/%d" %(length), lambda encoded=encoded: decodeString(encoded)
+
+    for qos in (0, 1):
+        for size in PAYLOAD_SIZES:
+            for length in TOPIC_LENGTHS:
+                msg = Publish(_id=1, topic=makeTopic(length), payload=b"x" * size,
+                              qos=qos, retain=False, dup=False)
+                name = "Publish/qos%d/payload%d/topic%d" %(qos, size, length)
+                yield name + "/pack", packCase(msg)
+                yield name + "/unpack", unpackCase(Publish, msg)
+
+    messages = (
+        ("Connect", Connect, Connect("client-0001", VERSION["v311"], keepalive=60,
+                                     username="user", password="secret")),
+        ("Connack", Connack, Connack(session=False, resultCode=0)),
+        ("Puback", Puback, Puback(1)),
+        ("Pubrec", Pubrec, Pubrec(1)),
+        ("Pubrel", Pubrel, Pubrel(1)),
+        ("Pubcomp", Pubcomp, Pubcomp(1)),
+        ("Subscribe", Subscribe, Subscribe(1, [(makeTopic(64), 1)])),
+        ("Suback", Suback, Suback(1, [(1, False)])),
+        ("Unsubscribe", Unsubscribe, Unsubscribe(1, [makeTopic(64)])),
+        ("Unsuback", Unsuback, Unsuback(1)),
+        ("Pingreq", Pingreq, Pingreq()),
+        ("Pingres", Pingres, Pingres()),
+        ("Disconnect", Disconnect, Disconnect()),
+    )
+    for name, cls, msg in messages:
+        yield name + "/pack", packCase(msg)
+        yield name + "/unpack", unpackCase(cls, msg)
+
+def timeCase(func, minTime, repeat):
+    """
+    Returns the best ns/op over repeat runs of at least minTime seconds.
+    """
+    number = 1
+    while True:
+        start = timer()
+        for _ in range(number):
+            func()
+        elapsed = timer() - start
+        if elapsed >= minTime / 10:
+            break
+        number *= 10
+    number = max(1, int(number * minTime / 10 / max(elapsed, 1e-9)))
+
+    best = None
+    gcEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = timer()
+            for _ in range(number):
+                func()
+            elapsed = (timer() - start) / number
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if gcEnabled:
+            gc.enable()
+    return best * 1e9
+
+def allocCase(func, runs=10):
+    """
+    Returns the bytes allocated per op: the traced memory peak of one call,
+    freed blocks included, averaged over runs.
+    """
+    if tracemalloc is None:
+        return None
+    total = 0
+    tracemalloc.start()
+    try:
+        func()
+        for _ in range(runs):
+            tracemalloc.clear_traces()
+            current = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            func()
+            total += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return total // runs
+
+def reference():
+    """
+    Fixed pure Python workload, timed with the benchmarks to scale out the
+    speed changes of the machine between runs.
+    """
+    values = list(range(64))
+    def work():
+        total = 0
+        for value in values:
+            total += value * 3 % 7
+        return total
+    return work
+
+def compare(results, baseline, threshold):
+    """
+    Returns the results regressing past threshold (relative) from baseline.
+    Timings are scaled by the reference of each run when both have one.
+    """
+    scale = 1.0
+    if results.get(REFERENCE) and baseline.get(REFERENCE):
+        scale = baseline[REFERENCE]["ns"] / results[REFERENCE]["ns"]
+
+    regressions = []
+    for name, res in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or name == REFERENCE:
+            continue
+        for key in ("ns", "bytes"):
+            if res.get(key) is None or not base.get(key):
+                continue
+            ratio = float(res[key]) / base[key]
+            if key == "ns":
+                ratio *= scale
+            if ratio > 1 + threshold:
+                regressions.append((name, key, base[key], res[key], ratio))
+    return regressions
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="MQTT codec microbenchmarks.")
+    parser.add_argument("--filter", default="", help="only run the benchmarks containing this text")
+    parser.add_argument("--min-time", type=float, default=0.1, help="seconds per timing run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default="bench_codec_baseline.json",
+                        help="baseline file to compare with")
+    parser.add_argument("--save", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="allowed relative regression before failing")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    results = {}
+    refs = []
+    for i, (name, func) in enumerate(cases()):
+        if args.filter not in name:
+            continue
+        if i % 10 == 0:
+            refs.append(timeCase(reference(), args.min_time, args.repeat))
+        ns = timeCase(func, args.min_time, args.repeat)
+        allocated = allocCase(func)
+        results[name] = {"ns": ns, "bytes": allocated}
+        print("%-48s %12.1f ns/op %10s B/op" %(name, ns, "-" if allocated is None else allocated))
+        sys.stdout.flush()
+
+    refs.append(timeCase(reference(), args.min_time, args.repeat))
+    results[REFERENCE] = {"ns": sum(refs) / len(refs), "bytes": None}
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save:
+        baseline = {}
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except (IOError, OSError):
+            pass
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("INFO: Baseline saved to %s" %(args.baseline))
+        sys.exit(0)
+
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except (IOError, OSError):
+        print("INFO: No baseline %s, run with --save to store one" %(args.baseline))
+        sys.exit(0)
+
+    regressions = compare(results, baseline, args.threshold)
+    for name, key, base, res, ratio in regressions:
+        print("ERROR: %s regressed: %s %.1f -> %.1f (%+.0f%%)" %(name, key, base, res, (ratio - 1) * 100))
+    if regressions:
+        sys.exit(1)
+    print("INFO: %d results within %.0f%% of the baseline" %(len(results), args.threshold * 100))
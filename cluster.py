@@ -0,0 +1,136 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import argparse
+import json
+import os
+import sys
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+
+from modules.broker import listen
+from modules.cluster import Supervisor, runWorker, loadSetup, subscribeShared
+
+# Environment variable handing the worker config over to the children, kept
+# off the command line where ps would show the credentials
+CONFIG_ENV = "MQTT_WORKER_CONFIG"
+
+def countingSetup(args):
+    """
+    Default worker setup: a shared subscription to --filter whose messages
+    are only counted.
+    """
+    def setup(worker, index):
+        subscribeShared(worker, args.group, args.filter, lambda payload: None, args.qos)
+    return setup
+
+def childArgv(args, index):
+    argv = [sys.executable, os.path.abspath(__file__), "--child", str(index),
+            "--group", args.group,
+            "--filter", args.filter, "--qos", str(args.qos),
+            "--report-interval", str(args.report_interval)]
+    if args.setup:
+        argv += ["--setup", args.setup]
+    if args.verbose:
+        argv.append("--verbose")
+    return argv
+
+def config(args):
+    if args.child is not None:
+        return json.loads(os.environ[CONFIG_ENV])
+    if args.config:
+        with open(args.config) as f:
+            return json.load(f)
+    return {
+      "endpoint": args.endpoint,
+      "version": "v311",
+      "client_id": "worker",
+      "username": None,
+      "app_key": None
+    }
+
+def report(supervisor, last):
+    stats = supervisor.stats()
+    rates = []
+    for index, received in sorted(stats["per_worker"].items()):
+        rates.append((received - last.get(index, received)) / args.report_interval)
+        last[index] = received
+    sys.stderr.write("INFO: %d/%d workers, %.0f msg/s %s, %d received, cpu %.1fs, "
+                     "rss %.0f MB, %d restarts\n"
+                     %(stats["workers"], args.processes, sum(rates),
+                       [int(rate) for rate in rates], stats["received"], stats["cpu"],
+                       stats["rss"] / 1024.0, stats["restarts"]))
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Runs MQTTWorker processes sharing a subscription.")
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument("--config", help="JSON worker config (client ids get the worker index)")
+    parser.add_argument("--endpoint", default="tcp:localhost:1883",
+                        help="broker endpoint when no config is given")
+    parser.add_argument("--setup", metavar="MODULE:FUNCTION",
+                        help="setup(worker, index) adding the subscriptions of a worker")
+    parser.add_argument("--group", default="workers", help="shared subscription group")
+    parser.add_argument("--filter", default="#", help="shared topic filter of the default setup")
+    parser.add_argument("--qos", type=int, default=0, choices=(0, 1, 2))
+    parser.add_argument("--report-interval", type=float, default=1.0)
+    parser.add_argument("--duration", type=float, default=0, help="stop after this many seconds")
+    parser.add_argument("--broker", metavar="DESCRIPTION",
+                        help="start a stand-in broker on this server endpoint, e.g. tcp:1883")
+    parser.add_argument("--verbose", action="store_true", help="keep the worker debug output")
+    parser.add_argument("--child", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    if args.child is not None:
+        setup = loadSetup(args.setup) if args.setup else countingSetup(args)
+        reactor.callWhenRunning(runWorker, reactor, config(args), setup, args.child,
+                                args.report_interval)
+        reactor.run()
+        sys.exit(0)
+
+    os.environ[CONFIG_ENV] = json.dumps(config(args))
+    supervisor = Supervisor(reactor, lambda index: childArgv(args, index), args.processes)
+
+    @inlineCallbacks
+    def main():
+        if args.broker:
+            port, factory = yield listen(reactor, args.broker)
+        supervisor.start()
+
+        last = {}
+        loop = LoopingCall(report, supervisor, last)
+        loop.start(args.report_interval, now=False)
+
+        if args.duration:
+            reactor.callLater(args.duration, reactor.stop)
+
+    reactor.addSystemEventTrigger("before", "shutdown", supervisor.stop)
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,342 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.internet.utils import getProcessOutputAndValue
+
+from modules.worker import MQTTWorker
+from modules.stats import Histogram
+
+SCENARIOS = ("connect-storm", "steady", "fan-in", "fan-out")
+
+class LoadStats(object):
+
+    def __init__(self):
+        self.clients = 0
+        self.connected = 0
+        self.connectStart = None
+        self.connectEnd = None
+        self.connectLatency = Histogram()
+        self.published = 0
+        self.received = 0
+        self.latency = Histogram()
+        self.duration = 0.0
+        self.cpu = 0.0
+        self.rss = 0
+
+    def toDict(self):
+        return {"clients": self.clients, "connected": self.connected,
+                "connect_span": self.connectSpan(),
+                "connect_latency": self.connectLatency.toDict(),
+                "published": self.published, "received": self.received,
+                "latency": self.latency.toDict(), "duration": self.duration,
+                "cpu": self.cpu, "rss": self.rss}
+
+    @classmethod
+    def fromDict(cls, d):
+        inst = cls()
+        inst.clients = d["clients"]
+        inst.connected = d["connected"]
+        inst.connectStart, inst.connectEnd = 0, d["connect_span"]
+        inst.connectLatency = Histogram.fromDict(d["connect_latency"])
+        inst.published = d["published"]
+        inst.received = d["received"]
+        inst.latency = Histogram.fromDict(d["latency"])
+        inst.duration = d["duration"]
+        inst.cpu = d["cpu"]
+        inst.rss = d["rss"]
+        return inst
+
+    def merge(self, other):
+        # Processes run concurrently: spans and durations do not add up
+        span = max(self.connectSpan(), other.connectSpan())
+        self.connectStart, self.connectEnd = 0, span
+        self.clients += other.clients
+        self.connected += other.connected
+        self.connectLatency.merge(other.connectLatency)
+        self.published += other.published
+        self.received += other.received
+        self.latency.merge(other.latency)
+        self.duration = max(self.duration, other.duration)
+        self.cpu += other.cpu
+        self.rss += other.rss
+
+    def connectSpan(self):
+        if self.connectEnd is None:
+            return 0
+        return self.connectEnd - (self.connectStart or 0)
+
+    def report(self):
+        clients = max(self.clients, 1)
+        span = self.connectSpan()
+        duration = self.duration or 1e-9
+
+        print("INFO: %d/%d clients connected in %.3fs (%.1f connects/s)"
+              %(self.connected, self.clients, span, self.connected / (span or 1e-9)))
+        self._percentiles("connect latency", self.connectLatency)
+        if self.published:
+            print("INFO: %d published (%.1f msg/s), %d received (%.1f msg/s)"
+                  %(self.published, self.published / duration,
+                    self.received, self.received / duration))
+            self._percentiles("delivery latency", self.latency)
+        print("INFO: CPU %.3f ms/client, RSS %.1f KB/client"
+              %(self.cpu * 1000.0 / clients, float(self.rss) / clients))
+
+    def _percentiles(self, name, histogram):
+        if not histogram.count:
+            return
+        s = histogram.summary()
+        print("INFO: %s ms: p50 %.2f  p90 %.2f  p99 %.2f  p99.9 %.2f  max %.2f"
+              %(name, s["p50"]*1000, s["p90"]*1000, s["p99"]*1000,
+                s["p99.9"]*1000, s["max"]*1000))
+
+class LoadClient(MQTTWorker):
+    """
+    Worker signaling when it joined the broker.
+    """
+
+    def __init__(self, reactor, config, stats):
+        MQTTWorker.__init__(self, reactor, config)
+        self.stats = stats
+        self.ready = Deferred()
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        MQTTWorker.start(self)
+
+    def joined(self, sessionPresent=False):
+        MQTTWorker.joined(self, sessionPresent)
+        if not self.ready.called:
+            now = time.time()
+            self.stats.connected += 1
+            self.stats.connectEnd = now
+            self.stats.connectLatency.record(now - self.started)
+            self.ready.callback(self)
+
+class LoadGenerator(object):
+
+    def __init__(self, reactor, args, index=0):
+        self.reactor = reactor
+        self.args = args
+        self.index = index
+        self.stats = LoadStats()
+        self.clients = []
+        self.loops = []
+        self.padding = "x" * max(0, args.payload_size - 18)
+
+    def _config(self, i):
+        return {
+          "endpoint": self.args.endpoint,
+          "version": "v311",
+          "client_id": "load-%d-%d-%d" %(os.getpid(), self.index, i),
+          "username": None,
+          "app_key": None
+        }
+
+    def onMessage(self, payload):
+        self.stats.received += 1
+        sent = float(payload.split(b"|", 1)[0])
+        self.stats.latency.record(time.time() - sent)
+
+    def publisher(self, client, topic):
+        def publish():
+            self.stats.published += 1
+            client.publish(topic, "%.6f|%s" %(time.time(), self.padding), self.args.qos)
+        loop = LoopingCall(publish)
+        self.loops.append(loop)
+        loop.start(1.0 / self.args.publish_rate, now=False)
+
+    @inlineCallbacks
+    def run(self):
+        args = self.args
+        clients = args.clients
+
+        # fan-in and fan-out have an extra client on the other side
+        if args.scenario in ("fan-in", "fan-out"):
+            clients += 1
+
+        self.stats.clients = clients
+        self.stats.connectStart = time.time()
+        for i in range(clients):
+            client = LoadClient(self.reactor, self._config(i), self.stats)
+            self.clients.append(client)
+            self.reactor.callLater(i / float(args.rate), client.start)
+
+        # Clients that can not join in time are left out of the scenario
+        timeout = self.reactor.callLater(args.connect_timeout, self._cancelWaits)
+        results = yield DeferredList([c.ready for c in self.clients], consumeErrors=True)
+        if timeout.active():
+            timeout.cancel()
+        joined = [c for c, (success, _) in zip(self.clients, results) if success]
+        if len(joined) < len(self.clients):
+            sys.stderr.write("ERROR: %d/%d clients not joined after %.1fs\n"
+                             %(len(self.clients) - len(joined), len(self.clients),
+                               args.connect_timeout))
+
+        minimum = 1 if args.scenario == "steady" else 2
+        if args.scenario != "connect-storm" and len(joined) < minimum:
+            sys.stderr.write("ERROR: Not enough clients joined to run %s\n" %(args.scenario))
+        elif args.scenario != "connect-storm":
+            topic = "load/%s/%d" %(args.scenario, self.index)
+            if args.scenario == "steady":
+                subscribers = [(c, "load/steady/%d/%d" %(self.index, i))
+                               for i, c in enumerate(joined)]
+                publishers = subscribers
+            elif args.scenario == "fan-in":
+                subscribers = [(joined[0], topic)]
+                publishers = [(c, topic) for c in joined[1:]]
+            else:
+                subscribers = [(c, topic) for c in joined[1:]]
+                publishers = [(joined[0], topic)]
+
+            yield DeferredList([c.subscribe(t, self.onMessage, args.qos)
+                                for c, t in subscribers])
+
+            start = time.time()
+            for c, t in publishers:
+                self.publisher(c, t)
+            yield deferLater(self.reactor, args.duration, lambda: None)
+            for loop in self.loops:
+                loop.stop()
+            self.stats.duration = time.time() - start
+
+            # Let in flight messages arrive
+            yield deferLater(self.reactor, 1.0, lambda: None)
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.stats.cpu = usage.ru_utime + usage.ru_stime
+        self.stats.rss = usage.ru_maxrss
+
+        yield DeferredList([c.stopService() for c in self.clients])
+        returnValue(self.stats)
+
+    def _cancelWaits(self):
+        for client in self.clients:
+            if not client.ready.called:
+                client.ready.cancel()
+
+@inlineCallbacks
+def runProcesses(args):
+    """
+    Splits the clients over several processes and merges their results.
+    """
+    outputs = []
+    for i in range(args.processes):
+        clients = args.clients // args.processes + (1 if i < args.clients % args.processes else 0)
+        argv = [os.path.abspath(__file__), "--child", str(i),
+                "--endpoint", args.endpoint, "--scenario", args.scenario,
+                "--clients", str(clients), "--rate", str(float(args.rate) / args.processes),
+                "--publish-rate", str(args.publish_rate), "--duration", str(args.duration),
+                "--payload-size", str(args.payload_size), "--qos", str(args.qos),
+                "--connect-timeout", str(args.connect_timeout)]
+        outputs.append(getProcessOutputAndValue(sys.executable, argv, env=os.environ))
+
+    results = yield DeferredList(outputs, consumeErrors=True)
+    stats = LoadStats()
+    for success, result in results:
+        if not success:
+            sys.stderr.write("ERROR: Load process failed: %s\n" %(result.getErrorMessage()))
+            continue
+        out, err, code = result
+        # Warnings of the children go to stderr, only the exit code tells a failure
+        lines = out.strip().splitlines()
+        if code != 0 or not lines:
+            sys.stderr.write("ERROR: Load process exited with %s: %s\n"
+                             %(code, err.decode("utf-8", "replace").strip()))
+            continue
+        stats.merge(LoadStats.fromDict(json.loads(lines[-1].decode("utf-8"))))
+    returnValue(stats)
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Simulates many concurrent MQTT clients.")
+    parser.add_argument("--endpoint", default="tcp:localhost:1883")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="steady")
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=500, help="client connections per second")
+    parser.add_argument("--publish-rate", type=float, default=1, help="messages per second per publisher")
+    parser.add_argument("--duration", type=float, default=10, help="publishing duration in seconds")
+    parser.add_argument("--payload-size", type=int, default=64)
+    parser.add_argument("--qos", type=int, default=0, choices=(0, 1, 2))
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--connect-timeout", type=float, default=30,
+                        help="seconds to wait for the clients to join")
+    parser.add_argument("--broker", metavar="DESCRIPTION",
+                        help="start a stand-in broker on this server endpoint, e.g. tcp:1883")
+    parser.add_argument("--verbose", action="store_true", help="keep the client debug output")
+    parser.add_argument("--child", type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Debug prints of thousands of clients would dominate the measure
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    broker = None
+    if args.broker and args.child is None:
+        # The broker runs apart so that only the clients are measured
+        broker = subprocess.Popen([sys.executable, "standin_broker.py", args.broker],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    @inlineCallbacks
+    def main():
+        if broker is not None:
+            yield deferLater(reactor, 1.0, lambda: None)
+
+        if args.processes > 1 and args.child is None:
+            stats = yield runProcesses(args)
+        else:
+            stats = yield LoadGenerator(reactor, args, args.child or 0).run()
+
+        quiet, sys.stdout = sys.stdout, stdout
+        if args.child is not None:
+            print(json.dumps(stats.toDict()))
+        else:
+            stats.report()
+        sys.stdout = quiet
+
+    def done(result):
+        if reactor.running:
+            reactor.stop()
+        return result
+
+    def failed(failure):
+        sys.stderr.write("ERROR: %s\n" %(failure.getTraceback()))
+
+    reactor.callWhenRunning(lambda: main().addErrback(failed).addBoth(done))
+    reactor.run()
+    if broker is not None:
+        broker.terminate()
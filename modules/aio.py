@@ -0,0 +1,281 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+"""
+asyncio client sharing the framing, codec and session bookkeeping of the
+Twisted implementation. Python 3 only.
+
+It only relies on the running asyncio loop, so it also works next to Twisted
+code when the asyncioreactor is installed (both then share the same loop).
+"""
+
+import asyncio
+from collections import deque
+
+from .definitions import *
+from .protocol import MQTTProtocol
+from .session import MQTTSession
+from .utils import jitterBackoffPolicy
+
+class StreamingNotSupported(Exception):
+    """
+    Raised by MQTTProtocol.publishStream on an asyncio connection: streaming
+    a payload needs a Twisted producer / consumer transport, use MQTTWorker.
+    """
+
+class _LoopClock(object):
+    """
+    Minimal IReactorTime.seconds() on top of an asyncio loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def seconds(self):
+        return self.loop.time()
+
+class _TransportAdapter(object):
+    """
+    Exposes an asyncio transport with the Twisted transport methods used by
+    MQTTProtocol.
+    """
+
+    def __init__(self, transport):
+        self._transport = transport
+
+    def write(self, data):
+        self._transport.write(data)
+
+    def writeSequence(self, data):
+        self._transport.writelines(data)
+
+    def loseConnection(self):
+        self._transport.close()
+
+    def abortConnection(self):
+        self._transport.abort()
+
+    def pauseProducing(self):
+        self._transport.pause_reading()
+
+    def resumeProducing(self):
+        self._transport.resume_reading()
+
+    def registerProducer(self, producer, streaming):
+        raise StreamingNotSupported("Streamed publish requires the Twisted client")
+
+    def unregisterProducer(self):
+        pass
+
+class AsyncioMQTTProtocol(MQTTProtocol, asyncio.Protocol):
+    """
+    MQTTProtocol driven by an asyncio transport.
+    """
+
+    def __init__(self):
+        MQTTProtocol.__init__(self)
+        # Cleared while the transport write buffer is above its high water mark
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def connection_made(self, transport):
+        self.makeConnection(_TransportAdapter(transport))
+
+    def data_received(self, data):
+        self.dataReceived(data)
+
+    def connection_lost(self, exc):
+        self.connectionLost(exc)
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+class Subscription(object):
+    """
+    Async iterator over the payloads received on a topic. Reading from the
+    socket is paused while more than maxsize payloads are waiting.
+    """
+
+    def __init__(self, client, topic, maxsize=1000):
+        self.client = client
+        self.topic = topic
+        self.maxsize = maxsize
+        self.queue = deque()
+        self.waiter = None
+        self.paused = False
+
+    def put(self, payload):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(payload)
+            self.waiter = None
+            return
+        self.queue.append(payload)
+        if len(self.queue) >= self.maxsize and not self.paused and self.client.protocol:
+            self.paused = True
+            self.client.protocol.transport.pauseProducing()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.queue:
+            payload = self.queue.popleft()
+            if self.paused and len(self.queue) <= self.maxsize // 2:
+                self.paused = False
+                if self.client.protocol:
+                    self.client.protocol.transport.resumeProducing()
+            return payload
+        self.waiter = self.client.loop.create_future()
+        return await self.waiter
+
+class AsyncMQTTClient(MQTTSession):
+    """
+    asyncio MQTT client. Takes the same config as MQTTWorker; the endpoint
+    must be a "tcp:host:port" description. The connection is reestablished
+    with the same backoff policy when it is lost.
+    """
+
+    def __init__(self, config, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+
+        kind, host, port = config["endpoint"].split(":")[:3]
+        if kind != "tcp":
+            raise Exception("Unsupported endpoint: %s" %(config["endpoint"]))
+        self.host = host
+        self.port = int(port)
+
+        self.version = VERSION[config["version"]]
+        self.clientId = config["client_id"]
+        self.username = config["username"]
+        self.appKey = config["app_key"]
+        self.cleanStart = config.get("clean_start", True)
+        self.maxPacketSize = config.get("max_packet_size", 0)
+        self.recorder = None
+
+        self.retryPolicy = jitterBackoffPolicy(_LoopClock(self.loop),
+                                               initialDelay=config.get("reconnect_initial_delay", 1.0),
+                                               maxDelay=config.get("reconnect_max_delay", 60.0),
+                                               factor=config.get("reconnect_factor", 2.0),
+                                               minInterval=config.get("connect_min_interval", 0.0))
+
+        self.initSession()
+
+        self.running = False
+        self._joined = None
+        # Single task reestablishing the connection
+        self._reconnecting = None
+
+    async def connect(self):
+        """
+        Connects and waits for the CONNACK. Returns the session present flag.
+        """
+        self.running = True
+        self._joined = self.loop.create_future()
+        transport, protocol = await self.loop.create_connection(AsyncioMQTTProtocol,
+                                                                self.host, self.port)
+        self.protocol = protocol
+        protocol.connect(self)
+        return await self._joined
+
+    async def disconnect(self):
+        self.running = False
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
+        if self.protocol is not None:
+            self.protocol.transport.loseConnection()
+
+    def joined(self, sessionPresent=False):
+        print("INFO: MQTT joined (session present: %s)" %(sessionPresent))
+        MQTTSession.joined(self, sessionPresent)
+        if self._joined is not None and not self._joined.done():
+            self._joined.set_result(sessionPresent)
+
+    def disconnected(self, protocol, reason):
+        print("INFO: Client Disconnected")
+        if self.protocol is protocol:
+            self.protocol = None
+        if self._joined is not None and not self._joined.done():
+            self._joined.set_exception(ConnectionError("Connection lost before CONNACK"))
+        # A running reconnection loop retries on its own when its attempt
+        # is lost before CONNACK
+        if self.running and (self._reconnecting is None or self._reconnecting.done()):
+            self._reconnecting = self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        attempt = 0
+        while self.running and not self.isConnected():
+            await asyncio.sleep(self.retryPolicy(attempt))
+            attempt += 1
+            try:
+                await self.connect()
+            except (OSError, ConnectionError) as e:
+                print("ERROR: Reconnection failed: %s" %(e))
+
+    def isConnected(self):
+        return self.protocol is not None and self.protocol.state == MQTTProtocol.CONNECTED
+
+    def _checkConnected(self):
+        if not self.isConnected():
+            raise ConnectionError("MQTT client not connected")
+
+    async def publish(self, topic, message, qos=0, retain=False):
+        """
+        Publishes a message, waiting first for the transport to drain if its
+        buffer is full, then for the acknowledgement if qos > 0.
+        """
+        self._checkConnected()
+        protocol = self.protocol
+        if not protocol.writable.is_set():
+            await protocol.writable.wait()
+        d = protocol.publish(topic, message, qos, retain)
+        if qos:
+            await d.asFuture(self.loop)
+
+    async def subscribe(self, topic, function=None, qos=0, maxsize=1000):
+        """
+        Subscribes to topic. Without function, returns a Subscription to
+        iterate with async for.
+        """
+        self._checkConnected()
+        subscription = None
+        if function is None:
+            subscription = Subscription(self, topic, maxsize)
+            function = subscription.put
+        await self.protocol.subscribe(topic, function, qos).asFuture(self.loop)
+        return subscription
+
+    async def unsubscribe(self, topic, function=None):
+        """
+        Removes a handler or Subscription of topic, all of them without
+        function. The topic is unsubscribed with its last handler.
+        """
+        if isinstance(function, Subscription):
+            function = function.put
+        if self.protocol is None:
+            self.removeTopic(topic, function)
+            return
+        await self.protocol.unsubscribe(topic, function).asFuture(self.loop)
@@ -0,0 +1,126 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+class ColumnarBatch(object):
+    """
+    Batch of fixed layout payloads decoded into NumPy arrays: columns is a
+    structured array with one field per layout entry, topicIndex the index
+    of the topic of each row in topics.
+    """
+
+    def __init__(self, topics, topicIndex, columns, dropped=0):
+        self.topics = topics
+        self.topicIndex = topicIndex
+        self.columns = columns
+        # Payloads not matching the layout size
+        self.dropped = dropped
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+class MessageBatcher(object):
+    """
+    Gathers the messages of a subscription and calls handler once per batch,
+    when maxMessages are waiting or maxDelay seconds after the first one.
+
+    The batch is a list of (topic, payload). With a layout (NumPy dtype
+    description of a fixed size binary payload, e.g.
+    [("timestamp", "<f8"), ("value", "<f4")]) it is a ColumnarBatch decoded
+    in one vectorized step. NumPy is only required with a layout.
+    """
+
+    def __init__(self, clock, handler, maxMessages=1000, maxDelay=0.05, layout=None):
+        self.clock = clock
+        self.handler = handler
+        self.maxMessages = maxMessages
+        self.maxDelay = maxDelay
+
+        self.dtype = None
+        if layout is not None:
+            import numpy
+            self.dtype = numpy.dtype(layout)
+
+        self.topics = []
+        self.payloads = []
+        self.timer = None
+
+        self.batches = 0
+        self.messages = 0
+
+    def add(self, topic, payload):
+        self.topics.append(topic)
+        self.payloads.append(payload)
+        if len(self.payloads) >= self.maxMessages:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.clock.callLater(self.maxDelay, self._expired)
+
+    def _expired(self):
+        self.timer = None
+        self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.payloads:
+            return
+
+        topics, self.topics = self.topics, []
+        payloads, self.payloads = self.payloads, []
+        self.batches += 1
+        self.messages += len(payloads)
+
+        if self.dtype is None:
+            self.handler(list(zip(topics, payloads)))
+        else:
+            self.handler(self._columnar(topics, payloads))
+
+    def _columnar(self, topics, payloads):
+        import numpy
+
+        size = self.dtype.itemsize
+        dropped = 0
+        if any(len(payload) != size for payload in payloads):
+            kept = [i for i, payload in enumerate(payloads) if len(payload) == size]
+            dropped = len(payloads) - len(kept)
+            print("ERROR: %d payloads not matching the batch layout" %(dropped))
+            topics = [topics[i] for i in kept]
+            payloads = [payloads[i] for i in kept]
+
+        columns = numpy.frombuffer(b"".join(payloads), dtype=self.dtype)
+
+        # Topics of the batch, and the index of each row among them
+        names, topicIndex = numpy.unique(numpy.array(topics), return_inverse=True)
+
+        return ColumnarBatch(names.tolist(), topicIndex, columns, dropped)
+
+    def stop(self):
+        """
+        Delivers the waiting messages.
+        """
+        self.flush()
@@ -0,0 +1,287 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.protocol import Factory
+
+from .definitions import *
+from .utils import topicMatches, splitShared
+from .protocol import MQTTProtocol
+from .tracing import stamp, BROKER
+from .messages import Connect, \
+                     Connack, \
+                     Subscribe, \
+                     Suback, \
+                     Publish, \
+                     Puback, \
+                     Pubrec, \
+                     Pubrel, \
+                     Pubcomp, \
+                     Pingres, \
+                     Unsubscribe, \
+                     Unsuback
+
+class MQTTBrokerProtocol(MQTTProtocol):
+    """
+    Server side of the stand-in broker. Reuses the client framing and packet
+    dispatch, only the handlers differ.
+    """
+
+    def __init__(self):
+        MQTTProtocol.__init__(self)
+        self.clientId = None
+        # QoS 2 packet ids received and not yet released
+        self.received = set()
+
+    def connectionMade(self):
+        # The factory provides what the framing expects from a worker
+        self.worker = self.factory
+
+    def _handleConnect(self, packet):
+        msg = Connect.unpack(packet)
+        self.clientId = msg.clientId
+        sessionPresent = self.factory.connect(self, msg.cleanStart)
+        self.state = self.CONNECTED
+        self._write(Connack(sessionPresent, 0).pack())
+
+    def _handleSubscribe(self, packet):
+        msg = Subscribe.unpack(packet)
+        for topic, qos in msg.topics:
+            self.factory.subscribe(self.clientId, topic, qos)
+        self._write(Suback(msg._id, [(qos, False) for topic, qos in msg.topics]).pack())
+
+    def _handleUnsubscribe(self, packet):
+        msg = Unsubscribe.unpack(packet)
+        for topic in msg.topics:
+            self.factory.unsubscribe(self.clientId, topic)
+        self._write(Unsuback(msg._id).pack())
+
+    def _handlePublish(self, packet):
+        msg = Publish.unpack(packet)
+        if msg.qos == QOS_1:
+            self._write(Puback(msg._id).pack())
+        elif msg.qos == QOS_2:
+            self._write(Pubrec(msg._id).pack())
+            if msg._id in self.received:
+                return
+            self.received.add(msg._id)
+        # Traced messages carry the time they went through the broker
+        msg.payload = stamp(msg.payload, BROKER)
+        self.factory.route(msg)
+
+    def _handlePubrel(self, packet):
+        msg = Pubrel.unpack(packet)
+        self.received.discard(msg._id)
+        self._write(Pubcomp(msg._id).pack())
+
+    def _handlePuback(self, packet):
+        pass
+
+    def _handlePubrec(self, packet):
+        msg = Pubrec.unpack(packet)
+        self._write(Pubrel(msg._id).pack())
+
+    def _handlePubcomp(self, packet):
+        pass
+
+    def _handlePingreq(self, packet):
+        self._write(Pingres().pack())
+
+    def _handleDisconnect(self, packet):
+        self.transport.loseConnection()
+
+    def deliver(self, topic, payload, qos, retain=False):
+        _id = self.idGenerator.next() if qos else None
+        msg = Publish(_id=_id, topic=topic, payload=payload, qos=qos, retain=retain, dup=False)
+        self._write(msg.pack())
+
+class SharedGroup(object):
+    """
+    Subscribers of a shared subscription, each message going to the next
+    connected one in turn.
+    """
+
+    def __init__(self):
+        self.members = []
+        self.qos = {}
+        self.next = 0
+
+    def add(self, clientId, qos):
+        if not clientId in self.qos:
+            self.members.append(clientId)
+        self.qos[clientId] = qos
+
+    def remove(self, clientId):
+        if clientId in self.qos:
+            del self.qos[clientId]
+            self.members.remove(clientId)
+
+    def pick(self, clients):
+        """
+        Returns the next connected member and its QoS, None if none is.
+        """
+        for _ in range(len(self.members)):
+            self.next = (self.next + 1) % len(self.members)
+            clientId = self.members[self.next]
+            if clientId in clients:
+                return clientId, self.qos[clientId]
+        return None
+
+class MQTTBrokerFactory(Factory):
+    """
+    Minimal in process MQTT broker used to test and benchmark the client
+    offline. Sessions are kept for clients connecting without clean start,
+    but messages published while a client is offline are not queued.
+    """
+    protocol = MQTTBrokerProtocol
+
+    # Attributes read by the framing of MQTTProtocol
+    streams = {}
+    maxPacketSize = 0
+    recorder = None
+    filters = None
+
+    def __init__(self):
+        # Map client id and connected protocol
+        self.clients = {}
+        # Map client id and their subscriptions {filter: qos}
+        self.sessions = {}
+        # Map exact topic / wildcard filter and {client id: qos}
+        self.exact = {}
+        self.wildcards = {}
+        # Map filter and {group: SharedGroup} of the shared subscriptions
+        self.shared = {}
+
+        self.published = 0
+        self.delivered = 0
+
+    def connect(self, protocol, cleanStart):
+        clientId = protocol.clientId
+        previous = self.clients.get(clientId)
+        if previous is not None and previous is not protocol:
+            previous.transport.loseConnection()
+
+        self.clients[clientId] = protocol
+        if cleanStart:
+            self._dropSession(clientId)
+            return False
+        return clientId in self.sessions
+
+    def disconnected(self, protocol, reason):
+        if self.clients.get(protocol.clientId) is protocol:
+            del self.clients[protocol.clientId]
+
+    def _dropSession(self, clientId):
+        for topic in self.sessions.pop(clientId, {}):
+            self.unsubscribe(clientId, topic)
+
+    def _index(self, topic):
+        if "+" in topic or "#" in topic:
+            return self.wildcards
+        return self.exact
+
+    def subscribe(self, clientId, topic, qos):
+        self.sessions.setdefault(clientId, {})[topic] = qos
+        group, topicFilter = splitShared(topic)
+        if group is not None:
+            groups = self.shared.setdefault(topicFilter, {})
+            groups.setdefault(group, SharedGroup()).add(clientId, qos)
+            return
+        self._index(topic).setdefault(topic, {})[clientId] = qos
+
+    def unsubscribe(self, clientId, topic):
+        self.sessions.get(clientId, {}).pop(topic, None)
+        group, topicFilter = splitShared(topic)
+        if group is not None:
+            groups = self.shared.get(topicFilter, {})
+            if group in groups:
+                groups[group].remove(clientId)
+                if not groups[group].members:
+                    del groups[group]
+                if not groups:
+                    del self.shared[topicFilter]
+            return
+        index = self._index(topic)
+        subscribers = index.get(topic)
+        if subscribers is not None:
+            subscribers.pop(clientId, None)
+            if not subscribers:
+                del index[topic]
+
+    def route(self, msg):
+        self.published += 1
+
+        # A client matching several filters receives the message once
+        targets = dict(self.exact.get(msg.topic, {}))
+        for topicFilter, subscribers in self.wildcards.items():
+            if topicMatches(topicFilter, msg.topic):
+                for clientId, qos in subscribers.items():
+                    targets[clientId] = max(qos, targets.get(clientId, 0))
+
+        for clientId, qos in targets.items():
+            protocol = self.clients.get(clientId)
+            if protocol is not None:
+                self.delivered += 1
+                protocol.deliver(msg.topic, msg.payload, min(qos, msg.qos), msg.retain)
+
+        # One member per shared group, on top of the other subscriptions
+        for topicFilter, groups in self.shared.items():
+            if not topicMatches(topicFilter, msg.topic):
+                continue
+            for group in groups.values():
+                member = group.pick(self.clients)
+                if member is not None:
+                    clientId, qos = member
+                    self.delivered += 1
+                    self.clients[clientId].deliver(msg.topic, msg.payload, min(qos, msg.qos), msg.retain)
+
+def _tlsServerFactory(factory, tls):
+    from twisted.internet import ssl
+    from twisted.protocols.tls import TLSMemoryBIOFactory
+
+    with open(tls["cert_file"], "rb") as f:
+        data = f.read()
+    with open(tls.get("key_file") or tls["cert_file"], "rb") as f:
+        data += b"\n" + f.read()
+    certificate = ssl.PrivateCertificate.loadPEM(data)
+    # Session tickets let the clients resume their TLS sessions
+    options = ssl.CertificateOptions(privateKey=certificate.privateKey.original,
+                                     certificate=certificate.original,
+                                     enableSessionTickets=True)
+    return TLSMemoryBIOFactory(options, False, factory)
+
+def listen(reactor, description="tcp:1883:interface=127.0.0.1", tls=None):
+    """
+    Starts a stand-in broker on a server endpoint description. With tls
+    (cert_file and key_file PEM paths) the connections are TLS.
+    Returns a Deferred firing with the listening port and the factory.
+    """
+    factory = MQTTBrokerFactory()
+    endpoint = serverFromString(reactor, description)
+    if tls:
+        d = endpoint.listen(_tlsServerFactory(factory, tls))
+    else:
+        d = endpoint.listen(factory)
+    d.addCallback(lambda port: (port, factory))
+    return d
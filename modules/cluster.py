@@ -0,0 +1,223 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import json
+import os
+import resource
+
+from importlib import import_module
+
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+
+from .stats import Histogram
+from .utils import jitterBackoffPolicy, sharedTopic
+from .worker import MQTTWorker
+
+# Workers report their metrics as JSON lines on this file descriptor, their
+# stdout and stderr being left to the logs
+METRICS_FD = 3
+
+def loadSetup(path):
+    """
+    Imports the "module:function" setup of the workers.
+    """
+    module, function = path.split(":")
+    return getattr(import_module(module), function)
+
+def subscribeShared(worker, group, topicFilter, function, qos=0):
+    """
+    Adds a handler of the shared subscription of group to topicFilter,
+    subscribed when the worker joins and on every reconnection.
+    """
+    topic = sharedTopic(group, topicFilter)
+    worker.addTopic(topic, function, qos)
+    if worker.protocol is not None and worker.protocol.state == worker.protocol.CONNECTED:
+        worker.protocol.sendSubscribe([(topic, qos)])
+
+def workerMetrics(worker, index):
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    metrics = {"index": index, "pid": os.getpid(), "received": worker.received,
+               "connected": worker.protocol is not None,
+               "cpu": usage.ru_utime + usage.ru_stime,
+               # KB on Linux
+               "rss": usage.ru_maxrss}
+    if worker.monitor is not None:
+        metrics["handlers"] = worker.monitor.handlers.toDict()
+    return metrics
+
+def runWorker(reactor, config, setup, index, interval=1.0):
+    """
+    Body of a worker process: starts an MQTTWorker with its own client id,
+    lets setup(worker, index) add its subscriptions and reports the metrics
+    every interval seconds.
+    """
+    config = dict(config)
+    config["client_id"] = "%s-%d" %(config["client_id"], index)
+    worker = MQTTWorker(reactor, config)
+    setup(worker, index)
+
+    def report():
+        line = json.dumps(workerMetrics(worker, index)) + "\n"
+        try:
+            os.write(METRICS_FD, line.encode("utf-8"))
+        except OSError:
+            # Supervisor gone
+            reactor.stop()
+
+    loop = LoopingCall(report)
+    loop.clock = reactor
+    loop.start(interval, now=False)
+
+    worker.start()
+    reactor.addSystemEventTrigger("before", "shutdown", worker.stopService)
+    return worker
+
+class WorkerProcess(ProcessProtocol):
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.buffer = b""
+        self.startedAt = supervisor.reactor.seconds()
+
+    def childDataReceived(self, fd, data):
+        if fd != METRICS_FD:
+            return
+        self.buffer += data
+        lines = self.buffer.split(b"\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            try:
+                self.supervisor.metrics[self.index] = json.loads(line.decode("utf-8"))
+            except ValueError:
+                print("ERROR: Invalid metrics from worker %d" %(self.index))
+
+    def processEnded(self, reason):
+        self.supervisor._ended(self, reason)
+
+class Supervisor(object):
+    """
+    Runs processes worker processes and restarts them when they exit, with
+    a jittered exponential backoff reset once a worker ran stableAfter
+    seconds. argv(index) returns the command line of a worker, which
+    reports its metrics on METRICS_FD (see runWorker).
+    """
+
+    def __init__(self, reactor, argv, processes, initialDelay=1.0, maxDelay=30.0,
+                 stableAfter=10.0):
+        self.reactor = reactor
+        self.argv = argv
+        self.processes = processes
+        self.stableAfter = stableAfter
+        self.policy = jitterBackoffPolicy(reactor, initialDelay=initialDelay,
+                                          maxDelay=maxDelay)
+
+        # Map index and running WorkerProcess
+        self.running = {}
+        self.attempts = {}
+        self.timers = {}
+        # Map index and last metrics
+        self.metrics = {}
+        self.restarts = 0
+
+        self.stopping = False
+        self._stopped = None
+
+    def start(self):
+        for index in range(self.processes):
+            self._spawn(index)
+
+    def _spawn(self, index):
+        self.timers.pop(index, None)
+        argv = self.argv(index)
+        process = WorkerProcess(self, index)
+        self.reactor.spawnProcess(process, argv[0], argv, env=os.environ,
+                                  childFDs={0: "w", 1: 1, 2: 2, METRICS_FD: "r"})
+        self.running[index] = process
+        print("INFO: Worker %d started (pid %s)" %(index, process.transport.pid))
+
+    def _ended(self, process, reason):
+        index = process.index
+        if self.running.get(index) is process:
+            del self.running[index]
+
+        if self.stopping:
+            if not self.running and self._stopped is not None:
+                d, self._stopped = self._stopped, None
+                d.callback(None)
+            return
+
+        uptime = self.reactor.seconds() - process.startedAt
+        if uptime >= self.stableAfter:
+            self.attempts[index] = 0
+        self.attempts[index] = self.attempts.get(index, 0) + 1
+        delay = self.policy(self.attempts[index])
+
+        print("ERROR: Worker %d exited (%s), restarting in %.1fs"
+              %(index, reason.getErrorMessage(), delay))
+        self.restarts += 1
+        self.timers[index] = self.reactor.callLater(delay, self._spawn, index)
+
+    def stop(self):
+        """
+        Terminates the workers. Returns a Deferred firing once all exited.
+        """
+        self.stopping = True
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        if not self.running:
+            return succeed(None)
+        self._stopped = Deferred()
+        for process in self.running.values():
+            try:
+                process.transport.signalProcess("TERM")
+            except Exception:
+                pass
+        return self._stopped
+
+    def stats(self):
+        """
+        Metrics of all the workers: summed counters and merged handler
+        time histograms.
+        """
+        res = {"workers": len(self.running), "restarts": self.restarts,
+               "received": 0, "cpu": 0.0, "rss": 0, "per_worker": {}}
+        handlers = None
+        for index, metrics in sorted(self.metrics.items()):
+            res["received"] += metrics["received"]
+            res["cpu"] += metrics["cpu"]
+            res["rss"] += metrics["rss"]
+            res["per_worker"][index] = metrics["received"]
+            if metrics.get("handlers"):
+                histogram = Histogram.fromDict(metrics["handlers"])
+                if handlers is None:
+                    handlers = histogram
+                else:
+                    handlers.merge(histogram)
+        if handlers is not None:
+            res["handlers"] = handlers.summary()
+        return res
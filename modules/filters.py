@@ -0,0 +1,91 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from .utils import TokenBucket
+
+class PreFilter(object):
+    """
+    Decides whether a received PUBLISH is delivered from its topic alone,
+    before its payload is copied or decoded. The checks, in order:
+        segments: {level index: value or list of values} the topic levels
+                  must have, e.g. {2: ["temperature", "humidity"]}
+        predicate: function of the topic returning whether it is kept
+        busy_bytes: drops when more received bytes than that are waiting
+                    to be parsed behind the message (0: never)
+        rate: keeps at most rate messages per second (0: no limit)
+        sample: keeps one message out of sample (0 or 1: all)
+    Dropped QoS 1/2 messages are still acknowledged.
+    """
+
+    def __init__(self, clock, segments=None, predicate=None, busyBytes=0, rate=0, sample=0):
+        self.segments = []
+        for index, values in (segments or {}).items():
+            if not isinstance(values, (list, tuple, set)):
+                values = [values]
+            self.segments.append((int(index), frozenset(values)))
+        self.predicate = predicate
+        self.busyBytes = busyBytes
+        self.bucket = TokenBucket(clock, rate) if rate else None
+        self.sample = sample
+        self._sampled = 0
+
+        self.hits = 0
+        self.passed = 0
+        self.dropped = {"segments": 0, "predicate": 0, "busy": 0, "rate": 0, "sample": 0}
+
+    def accept(self, topic, backlog=0):
+        """
+        Returns whether the message on topic is delivered, backlog being
+        the number of received bytes waiting behind it.
+        """
+        self.hits += 1
+        if self.segments:
+            levels = topic.split("/")
+            for index, values in self.segments:
+                if index >= len(levels) or not levels[index] in values:
+                    return self._drop("segments")
+        if self.predicate is not None and not self.predicate(topic):
+            return self._drop("predicate")
+        if self.busyBytes and backlog > self.busyBytes:
+            return self._drop("busy")
+        if self.bucket is not None:
+            if self.bucket.delay():
+                return self._drop("rate")
+            self.bucket.consume()
+        if self.sample > 1:
+            self._sampled += 1
+            if self._sampled < self.sample:
+                return self._drop("sample")
+            self._sampled = 0
+        self.passed += 1
+        return True
+
+    def _drop(self, reason):
+        self.dropped[reason] += 1
+        return False
+
+    def stats(self):
+        res = {"hits": self.hits, "passed": self.passed}
+        res.update(("dropped_%s" %(reason), count) for reason, count in self.dropped.items())
+        return res
@@ -0,0 +1,275 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import sys
+from collections import deque
+
+from twisted.internet.defer import Deferred, succeed, fail
+from twisted.internet.endpoints import clientFromString
+from twisted.internet.protocol import Factory
+from twisted.internet.task import LoopingCall
+
+from .protocol import MQTTProtocol
+from .definitions import *
+from .utils import jitterBackoffPolicy, TokenBucket
+from .session import MQTTSession
+
+class TimerWheel(object):
+    """
+    Single periodic timer shared by all the sessions of a manager. Calls are
+    rounded to the wheel resolution, which avoids one reactor DelayedCall per
+    session.
+    """
+
+    def __init__(self, reactor, resolution=0.1):
+        self.resolution = resolution
+        self.tick = 0
+        self.slots = {}
+        self.loop = LoopingCall(self._tick)
+        self.loop.clock = reactor
+        self.listeners = []
+
+    def start(self):
+        self.loop.start(self.resolution, now=False)
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def callLater(self, delay, f, *args):
+        """
+        Schedules f(*args). Returns a handle to give to cancel().
+        """
+        ticks = max(1, int(round(delay / self.resolution)))
+        call = [f, args]
+        self.slots.setdefault(self.tick + ticks, []).append(call)
+        return call
+
+    def cancel(self, call):
+        call[0] = None
+
+    def _tick(self):
+        self.tick += 1
+        for listener in self.listeners:
+            listener()
+        for f, args in self.slots.pop(self.tick, ()):
+            if f is not None:
+                f(*args)
+
+class Session(MQTTSession):
+    """
+    Lightweight MQTT client session hosted by a SessionManager. It shares its
+    endpoint, factory and configuration with the other sessions of the
+    manager.
+    """
+
+    __slots__ = ("manager", "clientId", "username", "appKey", "protocol",
+                 "idGenerator", "attempts", "timer", "subscribe_requests",
+                 "unsubscribe_requests", "topics", "wildcards", "streams",
+                 "batches", "bridges", "filters", "topics_qos",
+                 "publish_requests", "inflight", "conflated", "received",
+                 "inbound", "duplicates", "__weakref__")
+
+    # Not supported by gateway sessions
+    recorder = None
+
+    def __init__(self, manager, clientId, username=None, appKey=None):
+        self.manager = manager
+        self.clientId = clientId
+        self.username = username
+        self.appKey = appKey
+        self.attempts = 0
+        self.timer = None
+        self.initSession()
+
+    @property
+    def version(self):
+        return self.manager.version
+
+    @property
+    def cleanStart(self):
+        return self.manager.cleanStart
+
+    @property
+    def maxPacketSize(self):
+        return self.manager.maxPacketSize
+
+    def connected(self, protocol):
+        self.attempts = 0
+        self.protocol = protocol
+        protocol.connect(self)
+
+    def disconnected(self, protocol, reason):
+        if self.protocol is protocol:
+            self.protocol = None
+        self.manager._sessionLost(self)
+
+    def joined(self, sessionPresent=False):
+        self.manager.joined += 1
+        MQTTSession.joined(self, sessionPresent)
+
+    def _notConnected(self):
+        # Sessions are light: nothing is queued while they reconnect
+        return fail(Exception("Session %s not connected" %(self.clientId)))
+
+    def isConnected(self):
+        return self.protocol is not None and self.protocol.state == MQTTProtocol.CONNECTED
+
+    def subscribe(self, topic, function, qos=0):
+        if not self.isConnected():
+            return self._notConnected()
+        return self.protocol.subscribe(topic, function, qos)
+
+    def unsubscribe(self, topic, function=None):
+        if self.protocol is None:
+            self.removeTopic(topic, function)
+            return succeed(None)
+        return self.protocol.unsubscribe(topic, function)
+
+    def publish(self, topic, message, qos=0):
+        if not self.isConnected():
+            return self._notConnected()
+        return self.protocol.publish(topic, message, qos)
+
+    def memoryUsage(self):
+        """
+        Approximate number of bytes used by the session and its connection.
+        """
+        size = sys.getsizeof(self)
+        for name in ("subscribe_requests", "unsubscribe_requests", "topics",
+                     "streams", "batches", "topics_qos", "publish_requests",
+                     "inflight"):
+            value = getattr(self, name)
+            if value is not None:
+                size += sys.getsizeof(value)
+        size += sys.getsizeof(self.idGenerator) + sys.getsizeof(self.idGenerator.__dict__)
+
+        protocol = self.protocol
+        if protocol is not None:
+            size += sys.getsizeof(protocol) + sys.getsizeof(protocol.__dict__)
+            size += sys.getsizeof(protocol._buffer) + sys.getsizeof(protocol._pending)
+            size += sys.getsizeof(protocol.transport)
+        return size
+
+class SessionManager(object):
+    """
+    Hosts many MQTT client sessions in one process, e.g. for a gateway
+    representing each downstream device with its own client id.
+
+    All sessions share the endpoint, protocol factory, reconnection policy
+    and a single timer wheel. New connections are rate limited to
+    connect_rate per second.
+    """
+
+    def __init__(self, reactor, config):
+        self.reactor = reactor
+        self.endpoint = clientFromString(reactor, config["endpoint"])
+        self.factory = Factory.forProtocol(MQTTProtocol)
+        self.version = VERSION[config["version"]]
+        self.cleanStart = config.get("clean_start", True)
+        self.maxPacketSize = config.get("max_packet_size", 0)
+        self.connectRate = config.get("connect_rate", 100)
+
+        self.retryPolicy = jitterBackoffPolicy(reactor,
+                                               initialDelay=config.get("reconnect_initial_delay", 1.0),
+                                               maxDelay=config.get("reconnect_max_delay", 60.0),
+                                               factor=config.get("reconnect_factor", 2.0))
+
+        self.timers = TimerWheel(reactor, config.get("timer_resolution", 0.1))
+        self.timers.listeners.append(self._drainConnects)
+
+        # Map client id and session
+        self.sessions = {}
+
+        # Sessions waiting for a connection slot
+        self.connectQueue = deque()
+        self.connectBucket = TokenBucket(reactor, self.connectRate,
+                                         max(1.0, self.connectRate * self.timers.resolution))
+
+        self.running = False
+        self.joined = 0
+
+    def addSession(self, clientId, username=None, appKey=None):
+        session = Session(self, clientId, username, appKey)
+        self.sessions[clientId] = session
+        if self.running:
+            self.connectQueue.append(session)
+        return session
+
+    def getSession(self, clientId):
+        return self.sessions.get(clientId)
+
+    def removeSession(self, clientId):
+        session = self.sessions.pop(clientId, None)
+        if session is None:
+            return
+        if session.timer is not None:
+            self.timers.cancel(session.timer)
+        if session.protocol is not None:
+            session.protocol.transport.loseConnection()
+
+    def start(self):
+        print("INFO: Starting MQTT Session Manager (%d sessions)" %(len(self.sessions)))
+        self.running = True
+        self.connectQueue.extend(self.sessions.values())
+        self.timers.start()
+
+    def stop(self):
+        self.running = False
+        self.timers.stop()
+        self.connectQueue.clear()
+        for session in self.sessions.values():
+            if session.protocol is not None:
+                session.protocol.transport.loseConnection()
+
+    def _drainConnects(self):
+        while self.connectQueue and not self.connectBucket.delay():
+            self.connectBucket.consume()
+            self._connect(self.connectQueue.popleft())
+
+    def _connect(self, session):
+        if self.sessions.get(session.clientId) is not session:
+            return
+        session.timer = None
+        d = self.endpoint.connect(self.factory)
+        d.addCallbacks(session.connected, self._connectFailed, errbackArgs=(session,))
+
+    def _connectFailed(self, failure, session):
+        print("ERROR: Session %s failed to connect: %s" %(session.clientId, failure.getErrorMessage()))
+        self._sessionLost(session)
+
+    def _sessionLost(self, session):
+        if not self.running or self.sessions.get(session.clientId) is not session:
+            return
+        delay = self.retryPolicy(session.attempts)
+        session.attempts += 1
+        session.timer = self.timers.callLater(delay, self.connectQueue.append, session)
+
+    def memoryUsage(self):
+        """
+        Returns a dict mapping each client id to the approximate number of
+        bytes used by its session.
+        """
+        return dict((clientId, session.memoryUsage())
+                    for clientId, session in self.sessions.items())
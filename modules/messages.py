@@ -24,7 +24,7 @@
 
 import struct
 
-from definitions import *
+from .definitions import *
 
 __all__ = ( "Connect", "Connack", "Publish", "Puback", "Pubrec", "Pubrel",
             "Pubcomp", "Subscribe", "Suback", "Unsubscribe", "Unsuback",
@@ -39,6 +39,21 @@ def encodeString(string):
     string = string.encode("utf-8")
     return struct.pack(">H", len(string)) + string
 
+# Encoded topics are shared by every session of the process
+TOPIC_CACHE_SIZE = 4096
+_topicCache = {}
+
+def encodeTopic(topic):
+    '''
+    Same as encodeString, caching the result for the frequently used topics.
+    '''
+    encoded = _topicCache.get(topic)
+    if encoded is None:
+        if len(_topicCache) >= TOPIC_CACHE_SIZE:
+            _topicCache.clear()
+        encoded = _topicCache[topic] = encodeString(topic)
+    return encoded
+
 def decodeString(encoded):
     '''
     Decodes an UTF-8 string from an encoded MQTT bytearray.
@@ -52,7 +67,7 @@ def encodeLength(value):
     Encodes value into a multibyte sequence defined by MQTT protocol.
     Used to encode packet length fields.
     '''
-    encoded = ""
+    encoded = b""
     while True:
         digit = value % 128
         value //= 128
@@ -77,12 +92,36 @@ def decodeLength(encoded):
             break
     return value
 
+# Fixed headers of the acknowledgments sent for received PUBLISH, followed
+# by the packet id
+PUBACK_HEADER = b"\x40\x02"
+PUBREC_HEADER = b"\x50\x02"
+PUBCOMP_HEADER = b"\x70\x02"
+PACKET_ID = struct.Struct(">H")
+
+def packAck(header, _id):
+    return header + PACKET_ID.pack(_id)
+
 def getLength(packet):
     lenLen = 1
     while packet[lenLen] & 0x80:
         lenLen += 1
     return lenLen
 
+def publishHeader(packet):
+    '''
+    Parses the headers of a raw PUBLISH without copying its payload.
+    Returns the topic, QoS, packet id (None with QoS 0) and payload offset.
+    '''
+    offset = getLength(packet) + 1
+    qos = (packet[0] & 0x06) >> 1
+    topicLen = packet[offset]*256 + packet[offset+1]
+    topic = packet[offset+2:offset+2+topicLen].decode('utf-8')
+    offset += 2 + topicLen
+    if qos:
+        return topic, qos, packet[offset]*256 + packet[offset+1], offset + 2
+    return topic, qos, None, offset
+
 class Connect(object):
 
     def __init__ (self, clientId, version, keepalive=0, willTopic=None,
@@ -103,8 +142,8 @@ class Connect(object):
 
     def pack(self):
         header    = struct.pack("B", 0x10)
-        varHeader = ""
-        payload   = ""
+        varHeader = b""
+        payload   = b""
 
         # ---- Variable header encoding section -----
         varHeader += encodeString(self.version['tag'])
@@ -230,32 +269,34 @@ class Publish(object):
         self.retain = retain
         self.dup = dup
 
-    def pack(self):
-        header    = ""
-        varHeader = ""
-        payload   = ""
-
-        varHeader += encodeString(self.topic)
+    def packHeader(self, payloadLength):
+        '''
+        Encodes the fixed and variable headers of a PUBLISH carrying
+        payloadLength bytes. Used to stream the payload separately.
+        '''
+        varHeader = encodeTopic(self.topic)
         if self.qos > 0:
             qos = 0x30 | self.retain | (self.qos << 1) | (self.dup << 3)
             varHeader += struct.pack(">H", self._id)
         else:
             qos = 0x30 | self.retain
 
-        header += struct.pack("B", qos)
-        if isinstance(self.payload, str):
-            payload += self.payload
-        else:
-            print("ERROR: Invalid payload type")
-
-        totalLen = len(varHeader) + len(payload)
+        totalLen = len(varHeader) + payloadLength
         if totalLen > 268435455:
             raise Exception("ERROR PAYLOAD to big")
 
-        header += encodeLength(totalLen)
-        header += varHeader
-        header += payload
-        self.encoded = header
+        return struct.pack("B", qos) + encodeLength(totalLen) + varHeader
+
+    def pack(self):
+        payload = b""
+        if isinstance(self.payload, bytes):
+            payload = self.payload
+        elif isinstance(self.payload, type(u"")):
+            payload = self.payload.encode("utf-8")
+        else:
+            print("ERROR: Invalid payload type")
+
+        self.encoded = self.packHeader(len(payload)) + payload
 
         return self.encoded
 
@@ -273,10 +314,10 @@ class Publish(object):
 
         if qos:
             _id = struct.unpack(">H", packet_remaining[:2])[0]
-            payload = str(packet_remaining[2:])
+            payload = bytes(packet_remaining[2:])
         else:
             _id = None
-            payload = str(packet_remaining[:])
+            payload = bytes(packet_remaining[:])
 
         return cls (_id=_id, topic=topic, payload=payload,
                     qos=qos, retain=retain, dup=dup)
@@ -289,7 +330,7 @@ class Puback(object):
 
     def pack(self):
         header = struct.pack("B", 0x40)
-        varHeader = struct.pack("B", self._id)
+        varHeader = struct.pack(">H", self._id)
 
         header += encodeLength(len(varHeader))
         header += varHeader
@@ -315,7 +356,7 @@ class Pubrec(object):
 
     def pack(self):
         header = struct.pack("B", 0x50)
-        varHeader = struct.pack("B", self._id)
+        varHeader = struct.pack(">H", self._id)
 
         header += encodeLength(len(varHeader))
         header += varHeader
@@ -341,7 +382,7 @@ class Pubrel(object):
 
     def pack(self):
         header = struct.pack("B", 0x62) #XXX To Do: packet with QoS=1 Check What happen if not qos = 1
-        varHeader = struct.pack("B", self._id)
+        varHeader = struct.pack(">H", self._id)
 
         header += encodeLength(len(varHeader))
         header += varHeader
@@ -366,8 +407,8 @@ class Pubcomp(object):
         self._id = _id
 
     def pack(self):
-        header = struct.pack("B", 0x72)
-        varHeader = struct.pack("B", self._id)
+        header = struct.pack("B", 0x70)
+        varHeader = struct.pack(">H", self._id)
 
         header += encodeLength(len(varHeader))
         header += varHeader
@@ -395,7 +436,7 @@ class Subscribe(object):
     def pack(self):
         header    = struct.pack("B", 0x82) #XXX To Do: packet with QoS=1 Check What happen if not qos = 1
         varHeader = struct.pack(">H", self._id)
-        payload   = ""
+        payload   = b""
 
         for topic in self.topics:
             payload += encodeString(topic[0])
@@ -434,11 +475,11 @@ class Suback(object):
 
     def pack(self):
         header = struct.pack("B", 0x90)
-        varHeader = struct.pack("B", self._id)
-        payload = ""
+        varHeader = struct.pack(">H", self._id)
+        payload = b""
 
         for code in self.subscribed:
-            payload += code[0] | (0x80 if code[1] == True else 0x00)
+            payload += struct.pack("B", code[0] | (0x80 if code[1] == True else 0x00))
 
         header += encodeLength( len(varHeader)+len(payload) )
         header += varHeader
@@ -462,14 +503,14 @@ class Unsubscribe(object):
 
     def __init__(self, _id, topics):
         self.encoded = None
-        self._id = None
+        self._id = _id
         # List of topics
         self.topics = topics
 
     def pack(self):
         header    = struct.pack("B", 0xA2) #XXX To Do: packet with QoS=1 Check What happen if not qos = 1
         varHeader = struct.pack(">H", self._id)
-        payload   = ""
+        payload   = b""
 
         for topic in self.topics:
             payload += encodeString(topic)
@@ -492,7 +533,6 @@ class Unsubscribe(object):
         while len(packet_remaining):
             topic, packet_remaining = decodeString(packet_remaining)
             topics.append(topic)
-            packet_remaining = packet_remaining[1:]
 
         return cls (_id=_id, topics=topics)
 
@@ -504,7 +544,7 @@ class Unsuback(object):
 
     def pack(self):
         header = struct.pack("B", 0xB0)
-        varHeader = struct.pack("B", self._id)
+        varHeader = struct.pack(">H", self._id)
 
         header += encodeLength(len(varHeader))
         header += varHeader
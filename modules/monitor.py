@@ -0,0 +1,249 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import cProfile
+import os
+import pstats
+import signal
+import time
+
+from collections import deque
+
+from .stats import Histogram
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+timer = getattr(time, "perf_counter", time.time)
+
+PACKET_NAMES = (None, "CONNECT", "CONNACK", "PUBLISH", "PUBACK", "PUBREC",
+                "PUBREL", "PUBCOMP", "SUBSCRIBE", "SUBACK", "UNSUBSCRIBE",
+                "UNSUBACK", "PINGREQ", "PINGRESP", "DISCONNECT", None)
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler: the stack of the main thread is sampled on each
+    SIGPROF (CPU time interval), which keeps the overhead low enough for
+    production. Unix only.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = {}
+        self.count = 0
+        self._previous = None
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s:%s:%d" %(os.path.basename(code.co_filename),
+                                      code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        key = ";".join(reversed(stack))
+        self.samples[key] = self.samples.get(key, 0) + 1
+        self.count += 1
+
+    def collapsed(self):
+        """
+        Samples in the collapsed stack format of flame graph tools.
+        """
+        return "".join("%s %d\n" %(stack, n) for stack, n in
+                       sorted(self.samples.items(), key=lambda item: -item[1]))
+
+    def report(self, limit=30):
+        leaves = {}
+        for stack, n in self.samples.items():
+            leaf = stack.rsplit(";", 1)[-1]
+            leaves[leaf] = leaves.get(leaf, 0) + n
+        lines = ["%d samples" %(self.count)]
+        for leaf, n in sorted(leaves.items(), key=lambda item: -item[1])[:limit]:
+            lines.append("%6.2f%%  %s" %(100.0 * n / max(self.count, 1), leaf))
+        return "\n".join(lines)
+
+class ReactorMonitor(object):
+    """
+    Instruments the reactor and the MQTT hot path: the event loop lag is
+    sampled by a timer measuring how late it runs, and each packet dispatch and subscriber
+    handler is timed. Those over the threshold are logged and kept in a
+    bounded list. A cProfile or sampling profile can be started and stopped
+    at runtime, also with a signal.
+
+    config keys: lag_interval (s), slow_threshold (s), slow_log_size,
+    profile_mode ("cprofile" or "sampling"), profile_path, profile_signal
+    (e.g. "SIGUSR2").
+    """
+
+    def __init__(self, reactor, config=None):
+        config = config or {}
+        self.reactor = reactor
+        self.interval = config.get("lag_interval", 0.1)
+        self.threshold = config.get("slow_threshold", 0.01)
+        self.profileMode = config.get("profile_mode", "cprofile")
+        self.profilePath = config.get("profile_path")
+        self.profileSignal = config.get("profile_signal")
+
+        self.lag = Histogram()
+        self.packets = {}
+        self.handlers = Histogram()
+        self.reads = Histogram()
+        self.slow = deque(maxlen=config.get("slow_log_size", 100))
+
+        self.profiler = None
+        self._timer = None
+        self._expected = None
+
+    def start(self):
+        if self.interval and self._timer is None:
+            self._schedule()
+        if self.profileSignal:
+            signal.signal(getattr(signal, self.profileSignal), self._signalled)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self.profiler is not None:
+            self.stopProfile()
+
+    def _schedule(self):
+        self._expected = self.reactor.seconds() + self.interval
+        self._timer = self.reactor.callLater(self.interval, self._tick)
+
+    def _tick(self):
+        lag = max(self.reactor.seconds() - self._expected, 0)
+        self.lag.record(lag)
+        if lag > self.threshold:
+            self._slow("reactor lag", None, lag)
+        self._schedule()
+
+    def _slow(self, what, topic, duration):
+        if topic is None:
+            print("WARNING: Slow %s: %.1f ms" %(what, duration * 1000))
+        else:
+            print("WARNING: Slow %s on %s: %.1f ms" %(what, topic, duration * 1000))
+        self.slow.append({"what": what, "topic": topic, "duration": duration,
+                          "at": time.time()})
+
+    def timeRead(self, func, data):
+        start = timer()
+        func(data)
+        duration = timer() - start
+        self.reads.record(duration)
+        if duration > self.threshold:
+            self._slow("dataReceived of %d bytes" %(len(data)), None, duration)
+
+    def timePacket(self, func, packet):
+        start = timer()
+        func(packet)
+        duration = timer() - start
+        name = PACKET_NAMES[packet[0] >> 4]
+        histogram = self.packets.get(name)
+        if histogram is None:
+            histogram = self.packets[name] = Histogram()
+        histogram.record(duration)
+        if duration > self.threshold:
+            self._slow("%s dispatch" %(name), None, duration)
+
+    def timeHandler(self, topic, func, payload):
+        start = timer()
+        try:
+            return func(payload)
+        finally:
+            duration = timer() - start
+            self.handlers.record(duration)
+            if duration > self.threshold:
+                self._slow("handler %s" %(getattr(func, "__name__", func)), topic, duration)
+
+    # --------------------------------------------------------------------------
+    def _signalled(self, signum, frame):
+        # Leaves the signal handler before touching the profiler
+        self.reactor.callFromThread(self.toggleProfile)
+
+    def toggleProfile(self):
+        if self.profiler is None:
+            self.startProfile()
+        else:
+            report = self.stopProfile()
+            if not self.profilePath:
+                print(report)
+
+    def startProfile(self, mode=None):
+        if self.profiler is not None:
+            return
+        mode = mode or self.profileMode
+        print("INFO: Starting %s profile" %(mode))
+        if mode == "sampling":
+            self.profiler = SamplingProfiler()
+            self.profiler.start()
+        else:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stopProfile(self, path=None):
+        """
+        Stops the profile and returns its report. The raw profile (pstats or
+        collapsed stacks) is written to path or profile_path if set.
+        """
+        profiler, self.profiler = self.profiler, None
+        if profiler is None:
+            return None
+        path = path or self.profilePath
+
+        if isinstance(profiler, SamplingProfiler):
+            profiler.stop()
+            if path:
+                with open(path, "w") as f:
+                    f.write(profiler.collapsed())
+            report = profiler.report()
+        else:
+            profiler.disable()
+            if path:
+                profiler.dump_stats(path)
+            stream = StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(30)
+            report = stream.getvalue()
+
+        print("INFO: Profile stopped%s" %(" (%s)" %(path) if path else ""))
+        return report
+
+    def stats(self):
+        return {
+            "lag": self.lag.summary(),
+            "reads": self.reads.summary(),
+            "packets": dict((name, h.summary()) for name, h in self.packets.items()),
+            "handlers": self.handlers.summary(),
+            "slow": list(self.slow),
+            "profiling": self.profiler is not None
+        }
@@ -22,20 +22,57 @@
 # SOFTWARE.
 ################################################################################
 
+import time
+
+from collections import deque
+
 from twisted.internet.protocol import Protocol
 from twisted.internet.defer import Deferred, succeed
-
-from definitions import *
-from utils import IdGenerator
-from messages import decodeLength, \
+from twisted.web.client import FileBodyProducer
+from twisted.web.iweb import IBodyProducer, UNKNOWN_LENGTH
+
+from .definitions import *
+from .utils import IdGenerator, PacketIdSet
+from .recorder import INBOUND, OUTBOUND, RecordingConsumer
+from .scheduler import OutboundScheduler, QueuedPacket
+from .tracing import stamp, strip, ENCODED, SENT
+from .messages import decodeLength, \
+                     publishHeader, \
+                     packAck, \
+                     PUBACK_HEADER, \
+                     PUBREC_HEADER, \
+                     PUBCOMP_HEADER, \
+                     PACKET_ID, \
                      Connect, \
                      Connack, \
                      Subscribe, \
                      Suback, \
-                     Publish
+                     Publish, \
+                     Puback, \
+                     Pubrec, \
+                     Pubrel, \
+                     Pubcomp, \
+                     Unsubscribe, \
+                     Unsuback
+
+class _DiscardingConsumer(object):
+    """
+    Stream consumer of a QoS 2 PUBLISH received again before its release:
+    the payload is read off the connection and dropped.
+    """
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
 
 class MQTTProtocol(Protocol):
     worker = None
+    recorder = None
+    scheduler = None
+    monitor = None
+    tracer = None
 
     IDLE        = 0
     CONNECTING  = 1
@@ -45,6 +82,22 @@ class MQTTProtocol(Protocol):
         self._buffer = bytearray()
         self.state = self.IDLE
 
+        # Consumer and remaining bytes of the PUBLISH being streamed in
+        self._stream = None
+        self._streamRemaining = 0
+        self._streamAck = None
+
+        # Outgoing data queued while a payload is being streamed out
+        self._producing = False
+        self._pending = deque()
+
+        # Map topic and (QueuedPacket, Publish, Deferred) of the last
+        # conflated publish, replaced in place while it is not written
+        self._conflated = {}
+
+        # Time the data being dispatched was read, stamped when tracing
+        self._readAt = 0
+
         self.idGenerator = IdGenerator()
 
     def connect(self, worker):
@@ -53,53 +106,169 @@ class MQTTProtocol(Protocol):
         self.worker = worker
         self.state = self.CONNECTING
 
+        # Packet ids must stay unique across reconnections while the session
+        # (and its in flight messages) is kept by the broker.
+        self.idGenerator = self.worker.idGenerator
+        self.recorder = self.worker.recorder
+        self.monitor = getattr(self.worker, "monitor", None)
+        self.tracer = getattr(self.worker, "tracer", None)
+
+        config = getattr(self.worker, "scheduling", None)
+        if config:
+            self.scheduler = OutboundScheduler(self, config)
+            self.transport.registerProducer(self.scheduler, True)
+
         msg = Connect(self.worker.clientId,
                       self.worker.version,
                       username=self.worker.username,
-                      password=self.worker.appKey)
+                      password=self.worker.appKey,
+                      cleanStart=self.worker.cleanStart)
 
-        self.transport.write(msg.pack())
+        self._write(msg.pack())
 
-    def joined(self):
-        d = self.worker.joined()
+    def joined(self, sessionPresent):
+        d = self.worker.joined(sessionPresent)
+
+    def connectionLost(self, reason):
+        print("INFO: Connection Lost")
+        self.state = self.IDLE
+        if self.worker:
+            self.worker.disconnected(self, reason)
 
     def dataReceived(self, data):
         print("************ Data Received ***************", data)
+        if self.recorder:
+            self.recorder.record(INBOUND, data)
+        if self.tracer is not None:
+            self._readAt = time.time()
+        if self.monitor is not None:
+            self.monitor.timeRead(self._receive, data)
+        else:
+            self._receive(data)
+
+    def _receive(self, data):
+
+        # Payload of a streamed PUBLISH goes straight to its consumer
+        if self._stream is not None:
+            data = self._feedStream(data)
+            if not data:
+                return
+
         self._buffer.extend(data)
 
-        length = None
+        while len(self._buffer) >= 2:
+            # Calculate the length of the length field
+            lenLen = 1
+            while lenLen < len(self._buffer) and self._buffer[lenLen] & 0x80:
+                lenLen += 1
+                if lenLen > 4:
+                    print("ERROR: Malformed Remaining Length -- Aborting Connection")
+                    self.transport.abortConnection()
+                    return
 
-        while len(self._buffer):
-            if length is None:
-                # Start on a new packet
+            # We still haven't got all of the remaining length field
+            if lenLen >= len(self._buffer):
+                break
 
-                # Haven't got enough data to start a new packet, wait for some more
-                if len(self._buffer) < 2:
-                    break
+            length = decodeLength(self._buffer[1:lenLen+1])
+            total = length + lenLen + 1
 
-                lenLen = 1
-                # Calculate the length of the length field
-                while lenLen < len(self._buffer):
-                    if not self._buffer[lenLen] & 0x80:
+            if len(self._buffer) < total and \
+               (self._buffer[0] & 0xF0) >> 4 == PUBLISH and self.worker.streams:
+                started = self._startStream(lenLen, length)
+                if started is None:
+                    # Topic not fully received yet
+                    break
+                if started:
+                    if self._stream is not None:
                         break
-                    lenLen += 1
+                    continue
 
-                # We still haven't got all of the remaining length field
-                if lenLen < len(self._buffer) and self._buffer[lenLen] & 0x80:
-                    return
+            maxSize = self.worker.maxPacketSize
+            if maxSize and total > maxSize:
+                print("ERROR: Packet of %d bytes exceeds limit of %d -- Aborting Connection" %(total, maxSize))
+                self.transport.abortConnection()
+                return
 
-                length = decodeLength(self._buffer[1:])
+            if len(self._buffer) < total:
+                break
 
-            if len(self._buffer) >= length + lenLen + 1:
-                chunk = self._buffer[:length + lenLen + 1]
-                self._processPacket(chunk)
-                self._buffer = self._buffer[length + lenLen + 1:]
-                length = None
+            # Pre-filtered PUBLISH are dropped before being copied
+            if self.worker.filters and (self._buffer[0] & 0xF0) >> 4 == PUBLISH and \
+               self._filterPublish(total):
+                del self._buffer[:total]
+                continue
 
-            else:
-                break
+            packet = self._buffer[:total]
+            del self._buffer[:total]
+            self._processPacket(packet)
+
+    def _startStream(self, lenLen, length):
+        """
+        Checks whether the partially received PUBLISH at the head of the buffer
+        targets a streamed subscription, in which case its payload is handed to
+        the consumer as it arrives instead of being buffered.
+        Returns None if more data is needed to know the topic.
+        """
+        offset = lenLen + 1
+        qos = (self._buffer[0] & 0x06) >> 1
+        if len(self._buffer) < offset + 2:
+            return None
+        topicLen = self._buffer[offset]*256 + self._buffer[offset+1]
+        headerLen = offset + 2 + topicLen + (2 if qos else 0)
+        if len(self._buffer) < headerLen:
+            return None
+
+        topic = self._buffer[offset+2:offset+2+topicLen].decode('utf-8')
+        factory = self.worker.getStream(topic)
+        if factory is None:
+            return False
+
+        _id = None
+        if qos:
+            _id = self._buffer[headerLen-2]*256 + self._buffer[headerLen-1]
+            self._streamAck = (qos, _id)
+
+        payloadLen = length - (headerLen - offset)
+        self.worker.received += 1
+        if self._firstReceipt(qos, _id):
+            self._stream = factory(topic, payloadLen)
+        else:
+            self._stream = _DiscardingConsumer()
+        self._streamRemaining = payloadLen
+
+        data = bytes(self._buffer[headerLen:])
+        del self._buffer[:]
+        remaining = self._feedStream(data)
+        # Only the start of the next packet can follow the stream
+        self._buffer.extend(remaining)
+        return True
+
+    def _feedStream(self, data):
+        """
+        Forwards payload bytes to the current stream consumer.
+        Returns the data following the end of the streamed PUBLISH.
+        """
+        n = min(len(data), self._streamRemaining)
+        if n:
+            self._stream.write(data[:n])
+            self._streamRemaining -= n
+        if self._streamRemaining == 0:
+            stream, self._stream = self._stream, None
+            stream.close()
+            if self._streamAck is not None:
+                qos, _id = self._streamAck
+                self._streamAck = None
+                self._acknowledge(qos, _id)
+        return data[n:]
 
     def _processPacket(self, packet):
+        if self.monitor is not None:
+            self.monitor.timePacket(self._dispatchPacket, packet)
+        else:
+            self._dispatchPacket(packet)
+
+    def _dispatchPacket(self, packet):
         """
         Generic MQTT packet decoder
         """
@@ -147,7 +316,7 @@ class MQTTProtocol(Protocol):
         if res.resultCode == 0:
             self.state = self.CONNECTED
             # XXX To Do implement keepAlive
-            self.joined()
+            self.joined(res.session)
         else:
             self.state = self.IDLE
             print("ERROR: Connection Refused -- Aborting Connection")
@@ -155,22 +324,125 @@ class MQTTProtocol(Protocol):
 
     def _handlePublish(self, packet):
         print("DEBUG: Received PUBLISH")
+        if self.worker.bridges and self._bridgePublish(packet):
+            return
+
         res = Publish.unpack(packet)
+        self.worker.received += 1
+        if self._firstReceipt(res.qos, res._id):
+            self._deliver(res)
+        if res.qos:
+            self._acknowledge(res.qos, res._id)
+
+    def _bridgePublish(self, packet):
+        """
+        Forwards a PUBLISH matching a bridge with its payload bytes as
+        received. Returns False if no bridge matches.
+        """
+        topic, qos, _id, offset = publishHeader(packet)
+        bridge = self.worker.getBridge(topic)
+        if bridge is None:
+            return False
+        self.worker.received += 1
+        if self._firstReceipt(qos, _id):
+            bridge.forward(topic, bytes(packet[offset:]), qos)
+        if qos:
+            self._acknowledge(qos, _id)
+        return True
+
+    def _filterPublish(self, total):
+        """
+        Runs the PreFilter matching the PUBLISH at the head of the buffer.
+        Returns True if it is dropped, in which case it is acknowledged.
+        """
+        topic, qos, _id, offset = publishHeader(self._buffer)
+        prefilter = self.worker.getFilter(topic)
+        if prefilter is None or prefilter.accept(topic, len(self._buffer) - total):
+            return False
+        self.worker.received += 1
+        if qos:
+            self._firstReceipt(qos, _id)
+            self._acknowledge(qos, _id)
+        return True
+
+    def _firstReceipt(self, qos, _id):
+        """
+        Exactly once: a QoS 2 message is delivered on its first PUBLISH,
+        the retransmissions before its PUBREL are only acknowledged.
+        """
+        if qos != QOS_2:
+            return True
+        if self.worker.inbound is None:
+            self.worker.inbound = PacketIdSet()
+        if not self.worker.inbound.add(_id):
+            self.worker.duplicates += 1
+            return False
+        return True
+
+    def _acknowledge(self, qos, _id):
+        if qos == QOS_1:
+            self._write(packAck(PUBACK_HEADER, _id))
+        elif qos == QOS_2:
+            self._write(packAck(PUBREC_HEADER, _id))
+
+    def _deliver(self, res):
+        trace = None
+        if self.tracer is not None:
+            trace = self.tracer.received(res, self._readAt)
+        else:
+            res.payload = strip(res.payload)
+        # Packets received whole before a stream could start
+        if self.worker.streams:
+            factory = self.worker.getStream(res.topic)
+            if factory is not None:
+                stream = factory(res.topic, len(res.payload))
+                stream.write(res.payload)
+                stream.close()
+                return
+        if self.worker.batches:
+            batcher = self.worker.getBatch(res.topic)
+            if batcher is not None:
+                batcher.add(res.topic, res.payload)
+                return
         func = self.worker.getTopic(res.topic)
         if func:
-            func(res.payload)
+            if trace is not None:
+                self.tracer.handle(trace, func, res.payload)
+            elif self.monitor is not None:
+                self.monitor.timeHandler(res.topic, func, res.payload)
+            else:
+                func(res.payload)
 
     def _handlePuback(self, packet):
         print("DEBUG: Received PUBACK")
+        res = Puback.unpack(packet)
+        self.worker.removeInflight(res._id)
+        d = self.worker.getPublishRequest(res._id, remove=True)
+        if d:
+            d.callback(None)
 
     def _handlePubrec(self, packet):
         print("DEBUG: Received PUBREC")
+        res = Pubrec.unpack(packet)
+        msg = Pubrel(_id=res._id)
+        # From now on the PUBREL is what must be resent on reconnection
+        self.worker.addInflight(msg)
+        self._write(msg.pack())
 
     def _handlePubrel(self, packet):
         print("DEBUG: Received PUBREL")
+        _id = PACKET_ID.unpack_from(packet, len(packet) - 2)[0]
+        if self.worker.inbound is not None:
+            self.worker.inbound.discard(_id)
+        self._write(packAck(PUBCOMP_HEADER, _id))
 
     def _handlePubcomp(self, packet):
         print("DEBUG: Received PUBCOMP")
+        res = Pubcomp.unpack(packet)
+        self.worker.removeInflight(res._id)
+        d = self.worker.getPublishRequest(res._id, remove=True)
+        if d:
+            d.callback(None)
 
     def _handleSubscribe(self, packet):
         print("DEBUG: Received SUBSCRIBE")
@@ -187,6 +459,10 @@ class MQTTProtocol(Protocol):
 
     def _handleUnsuback(self, packet):
         print("DEBUG: Received UNSUBACK")
+        res = Unsuback.unpack(packet)
+        d = self.worker.getUnsubscribeRequest(res._id, remove=True)
+        if d:
+            d.callback(None)
 
     def _handlePingreq(self, packet):
         print("DEBUG: Received PINGREQ")
@@ -200,29 +476,108 @@ class MQTTProtocol(Protocol):
     def subscribe(self, topic, function, qos=0):
         print("DEBUG: Subscribing to topic %s"%(topic))
 
-        # XXX Check if number of in fligth suscribe is not > than window
-        # if len(self.factory.windowSubscribe[self.addr]) == self._window:
-        #     raise MQTTWindowError("subscription requests exceeded limit", self._window)
+        if not ( 0<= qos < 3):
+            raise Exception("Invalid QOS")
+
+        if not self.worker.addTopic(topic, function, qos):
+            # Shares the subscription of the other handlers
+            return succeed([(self.worker.topics_qos[topic], False)])
+        return self.sendSubscribe([(topic, qos)])
+
+    def subscribeBatch(self, topicFilter, batcher, qos=0):
+        """
+        Subscribes to topicFilter (wildcards allowed), delivering its
+        messages in batches through a MessageBatcher.
+        """
+        print("DEBUG: Subscribing to batch topic %s"%(topicFilter))
 
         if not ( 0<= qos < 3):
             raise Exception("Invalid QOS")
 
+        self.worker.addBatch(topicFilter, batcher, qos)
+        return self.sendSubscribe([(topicFilter, qos)])
+
+    def unsubscribeBatch(self, topicFilter):
+        if not self.worker.removeBatch(topicFilter) or self.state != self.CONNECTED:
+            return succeed(None)
+        return self.sendUnsubscribe([topicFilter])
+
+    def unsubscribe(self, topic, function=None):
+        """
+        Removes a handler of topic, all of them without function. The topic
+        is unsubscribed once it has no handler left.
+        """
+        return self.unsubscribeMany([(topic, function)])
+
+    def unsubscribeMany(self, handlers):
+        """
+        Removes a list of (topic, function) handlers, sending a single
+        UNSUBSCRIBE for the topics left without handler. Returns a Deferred
+        firing once unsubscribed.
+        """
+        topics = []
+        for topic, function in handlers:
+            if self.worker.removeTopic(topic, function) and not topic in topics:
+                topics.append(topic)
+        if not topics or self.state != self.CONNECTED:
+            return succeed(None)
+        return self.sendUnsubscribe(topics)
+
+    def sendUnsubscribe(self, topics):
+        _id = self.idGenerator.next()
+        msg = Unsubscribe(_id=_id, topics=topics)
+        d = Deferred()
+
+        self.worker.addUnsubscribeRequest(msg, d)
+        self._write(msg.pack())
+
+        return d
+
+    def subscribeStream(self, topic, factory, qos=0):
+        """
+        Subscribes to topic, streaming payloads instead of buffering them:
+        for every PUBLISH, factory(topic, length) is called and must return a
+        consumer whose write(data) receives the payload chunks and close() is
+        called once the payload is complete.
+        """
+        print("DEBUG: Subscribing to stream topic %s"%(topic))
+
+        if not ( 0<= qos < 3):
+            raise Exception("Invalid QOS")
+
+        self.worker.addStream(topic, factory, qos)
+        return self.sendSubscribe([(topic, qos)])
+
+    def sendSubscribe(self, topics):
+        # XXX Check if number of in fligth suscribe is not > than window
+        # if len(self.factory.windowSubscribe[self.addr]) == self._window:
+        #     raise MQTTWindowError("subscription requests exceeded limit", self._window)
+
         # XXX To do Add time out check.
         _id = self.idGenerator.next()
-        msg = Subscribe(_id=_id, topics=[(topic, qos)])
+        msg = Subscribe(_id=_id, topics=topics)
         d = Deferred()
 
         self.worker.addSubscribeRequest(msg, d)
-        self.worker.addTopic(topic, function)
-        self.transport.write(msg.pack())
+        self._write(msg.pack())
 
         return d
 
-    def publish(self, topic, message, qos=0, retain=False):
-
+    def publish(self, topic, message, qos=0, retain=False, priority=None, conflate=False):
+        """
+        Publishes message on topic. With conflate, a message of the same
+        topic and retain flag still waiting to be written has its payload
+        replaced instead of queuing a new one, and its QoS raised if lower.
+        """
         if not ( 0<= qos < 3):
             raise Exception("Invalid QOS")
 
+        if conflate:
+            queued = self._conflated.get(topic)
+            if queued is not None and queued[0].data is not None and \
+               queued[1].retain == retain:
+                return self._conflate(topic, queued, message, qos)
+
         _id = self.idGenerator.next()
         msg = Publish(_id=_id, topic=topic, payload=message, qos=qos, retain=retain, dup=False)
 
@@ -232,6 +587,143 @@ class MQTTProtocol(Protocol):
             d = Deferred()
             # XXX To DO: Add timer to check timeout
             self.worker.addPublishRequest(msg, d)
+            self.worker.addInflight(msg)
+
+        cls = None
+        if self.scheduler is not None:
+            cls = self.scheduler.classFor(topic, priority)
+        data = msg.pack()
+        if self.tracer is not None:
+            data = stamp(data, ENCODED)
+        packet = self._write(data, cls)
+        if conflate:
+            if packet is not None:
+                self._conflated[topic] = (packet, msg, d)
+            else:
+                self._conflated.pop(topic, None)
+        return d
+
+    def _conflate(self, topic, queued, message, qos):
+        packet, msg, d = queued
+        msg.payload = message
+        if qos > msg.qos:
+            if msg.qos == QOS_0:
+                # From now on acknowledged like any QoS 1/2 publish
+                d = Deferred()
+                self.worker.addPublishRequest(msg, d)
+                self.worker.addInflight(msg)
+                self._conflated[topic] = (packet, msg, d)
+            msg.qos = qos
+        packet.data = msg.pack()
+        self.worker.conflated += 1
+
+        if qos == QOS_0:
+            return succeed(None)
+        # Both publishers are acknowledged by the same PUBACK / PUBCOMP
+        res = Deferred()
+        def chain(result):
+            res.callback(result)
+            return result
+        d.addCallback(chain)
+        return res
+
+    def publishStream(self, topic, body, qos=0, retain=False, chunkSize=65536):
+        """
+        Publishes a payload without building it in memory. body is either a
+        file like object (file, mmap, ...) which is closed once sent, or an
+        IBodyProducer of known length. The payload is written in chunks with
+        the transport flow control, other packets being queued meanwhile.
+        """
+        if not ( 0<= qos < 3):
+            raise Exception("Invalid QOS")
+
+        if not IBodyProducer.providedBy(body):
+            body = FileBodyProducer(body, readSize=chunkSize)
+        if body.length is UNKNOWN_LENGTH:
+            raise Exception("Stream length must be known")
+
+        _id = self.idGenerator.next()
+        msg = Publish(_id=_id, topic=topic, payload=None, qos=qos, retain=retain, dup=False)
+        header = msg.packHeader(body.length)
+
+        written = Deferred()
+        if msg.qos == QOS_0:
+            d = written
+        else:
+            # Streamed payloads can not be kept for retransmission
+            d = Deferred()
+            self.worker.addPublishRequest(msg, d)
+            written.addErrback(d.errback)
 
-        self.transport.write(msg.pack())
+        if self._producing:
+            self._pending.append((header, body, written))
+        else:
+            self._produce(header, body, written)
         return d
+
+    def _produce(self, header, body, written):
+        self._producing = True
+        if self.scheduler is not None:
+            # The payload is written as a whole, bypassing the priorities
+            self.transport.unregisterProducer()
+            self.scheduler.pauseProducing()
+        self._send(header)
+        self.transport.registerProducer(body, True)
+
+        def done(result):
+            self.transport.unregisterProducer()
+            self._producing = False
+            if self.scheduler is not None:
+                self.transport.registerProducer(self.scheduler, True)
+                self.scheduler.resumeProducing()
+            self._flushPending()
+            return result
+
+        consumer = self.transport
+        if self.recorder:
+            consumer = RecordingConsumer(self.transport, self.recorder)
+        d = body.startProducing(consumer)
+        d.addBoth(done)
+        d.chainDeferred(written)
+
+    def _flushPending(self):
+        while self._pending and not self._producing:
+            item = self._pending.popleft()
+            if isinstance(item, QueuedPacket):
+                self._write(item.data, item.cls, item)
+            else:
+                self._produce(*item)
+
+    def _write(self, data, cls=None, packet=None):
+        """
+        Writes a packet, through the outbound scheduler if any. cls is its
+        priority class (the control class by default).
+        Returns the QueuedPacket if the packet has to wait, None if written.
+        """
+        if self._producing:
+            if packet is None:
+                packet = QueuedPacket(data)
+            packet.cls = cls
+            self._pending.append(packet)
+            return packet
+        if self.scheduler is not None:
+            return self.scheduler.write(data, cls, packet)
+        self._send(data)
+        if packet is not None:
+            packet.data = None
+        return None
+
+    def _send(self, data):
+        if self.tracer is not None:
+            data = stamp(data, SENT)
+        if self.recorder:
+            self.recorder.record(OUTBOUND, data)
+        self.transport.write(data)
+
+    def resend(self, msg, dup=True):
+        """
+        Retransmits an in flight PUBLISH or PUBREL after a reconnection.
+        """
+        if isinstance(msg, Publish):
+            msg.dup = dup
+        self._write(msg.pack())
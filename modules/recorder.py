@@ -0,0 +1,207 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import struct
+import time
+
+from twisted.internet.defer import Deferred
+
+MAGIC = b"MQTR\x01"
+
+INBOUND  = 0
+OUTBOUND = 1
+
+# Timestamp (seconds since epoch), direction and length of the frame
+RECORD_HEADER = struct.Struct(">dBI")
+
+class TrafficRecorder(object):
+    """
+    Appends every chunk of data received from or written to the broker to a
+    compact binary log: a magic string followed by records made of
+    RECORD_HEADER and the raw bytes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def record(self, direction, data):
+        self._file.write(RECORD_HEADER.pack(time.time(), direction, len(data)))
+        self._file.write(bytes(data))
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+class RecordingConsumer(object):
+    """
+    Consumer proxy recording the payload chunks streamed to the transport.
+    """
+
+    def __init__(self, transport, recorder):
+        self.transport = transport
+        self.recorder = recorder
+
+    def write(self, data):
+        self.recorder.record(OUTBOUND, data)
+        self.transport.write(data)
+
+def readRecords(path):
+    """
+    Generator over the (timestamp, direction, data) records of a log file.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("Invalid traffic record file: %s" %(path))
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            timestamp, direction, length = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                print("WARNING: Truncated record at the end of %s" %(path))
+                break
+            yield timestamp, direction, data
+
+class NullTransport(object):
+    """
+    Transport discarding written data, used to drive a protocol offline.
+    """
+    disconnecting = False
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def writeSequence(self, data):
+        for d in data:
+            self.write(d)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+    def loseConnection(self):
+        self.disconnecting = True
+
+    def abortConnection(self):
+        self.disconnecting = True
+
+class Replayer(object):
+    """
+    Feeds the inbound traffic of a record file into a protocol and measures
+    the parsing and dispatch throughput.
+
+    speed is the replay rate relative to the recording (1: original speed,
+    N: N times faster); 0 replays as fast as possible without the reactor.
+    """
+
+    def __init__(self, path, protocol, speed=0):
+        self.path = path
+        self.protocol = protocol
+        self.speed = speed
+
+        self.chunks = 0
+        self.bytes = 0
+        self.packets = 0
+        self.elapsed = 0.0
+
+        # Count dispatched packets without touching the protocol class
+        process = protocol._processPacket
+        def countingProcess(packet):
+            self.packets += 1
+            process(packet)
+        protocol._processPacket = countingProcess
+
+    def _inbound(self):
+        for timestamp, direction, data in readRecords(self.path):
+            if direction == INBOUND:
+                yield timestamp, data
+
+    def _feed(self, data):
+        self.chunks += 1
+        self.bytes += len(data)
+        self.protocol.dataReceived(data)
+
+    def run(self, reactor=None):
+        """
+        Replays the file. Returns a Deferred firing with the statistics once
+        done.
+        """
+        if not self.speed:
+            start = time.time()
+            for timestamp, data in self._inbound():
+                self._feed(data)
+            self.elapsed = time.time() - start
+            d = Deferred()
+            d.callback(self.stats())
+            return d
+
+        if reactor is None:
+            from twisted.internet import reactor
+
+        done = Deferred()
+        records = self._inbound()
+        origin = [None, None]
+
+        def step():
+            for timestamp, data in records:
+                if origin[0] is None:
+                    origin[0], origin[1] = timestamp, time.time()
+                due = origin[1] + (timestamp - origin[0]) / float(self.speed)
+                delay = due - time.time()
+                if delay > 0:
+                    reactor.callLater(delay, feedAndContinue, data)
+                    return
+                self._feed(data)
+            if origin[1] is not None:
+                self.elapsed = time.time() - origin[1]
+            done.callback(self.stats())
+
+        def feedAndContinue(data):
+            self._feed(data)
+            step()
+
+        reactor.callLater(0, step)
+        return done
+
+    def stats(self):
+        elapsed = self.elapsed or 1e-9
+        return {
+            "chunks": self.chunks,
+            "bytes": self.bytes,
+            "packets": self.packets,
+            "elapsed": self.elapsed,
+            "packets_per_second": self.packets / elapsed,
+            "megabytes_per_second": self.bytes / elapsed / 1e6
+        }
@@ -0,0 +1,190 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from twisted.internet.defer import DeferredList
+from twisted.internet.task import LoopingCall
+
+# Settings of the main connection not inherited by the routed connections
+NOT_INHERITED = ("routes", "bridges", "monitor", "tracing", "record_file", "rpc_reply_topic")
+
+DEFAULT = "default"
+
+class Route(object):
+    """
+    Connection carrying the topics starting with prefix, with the QoS used
+    when a publish or subscribe does not give one.
+    """
+
+    def __init__(self, clock, name, prefix, worker, qos=0):
+        self.clock = clock
+        self.name = name
+        self.prefix = prefix
+        self.worker = worker
+        self.qos = qos
+
+        self.published = 0
+        self.publishedBytes = 0
+        self.bridged = 0
+        # Rates over the last sampling interval, see sample()
+        self.publishRate = 0.0
+        self.receiveRate = 0.0
+        self._last = (clock.seconds(), 0, 0)
+
+    def publish(self, topic, message, qos=None, priority=None, conflate=False):
+        self.published += 1
+        self.publishedBytes += len(message)
+        return self.worker._publish(topic, message, self.qos if qos is None else qos,
+                                    priority, conflate)
+
+    def subscribe(self, topic, function, qos=None):
+        return self.worker._subscribe(topic, function, self.qos if qos is None else qos)
+
+    def sample(self):
+        """
+        Updates the rates with the messages since the previous sample.
+        """
+        now = self.clock.seconds()
+        since, published, received = self._last
+        elapsed = (now - since) or 1e-9
+        self._last = (now, self.published, self.worker.received)
+        self.publishRate = (self.published - published) / elapsed
+        self.receiveRate = (self.worker.received - received) / elapsed
+
+    def stats(self):
+        return {"prefix": self.prefix,
+                "published": self.published,
+                "published_bytes": self.publishedBytes,
+                "received": self.worker.received,
+                "bridged": self.bridged,
+                "publish_rate": self.publishRate,
+                "receive_rate": self.receiveRate,
+                "offline": len(self.worker.offline)}
+
+class Bridge(object):
+    """
+    Forwards the messages received on a filter of one connection to another
+    one. Payloads are passed as received, only the topic is rewritten:
+    strip is removed from its start and prefix added.
+    """
+
+    def __init__(self, source, target, topicFilter, strip="", prefix="", qos=None):
+        self.source = source
+        self.target = target
+        self.topicFilter = topicFilter
+        self.strip = strip
+        self.prefix = prefix
+        self.qos = qos
+
+    def forward(self, topic, payload, qos):
+        if self.strip and topic.startswith(self.strip):
+            topic = topic[len(self.strip):]
+        self.source.bridged += 1
+        self.target.publish(self.prefix + topic, payload,
+                            qos if self.qos is None else min(qos, self.qos))
+
+class Router(object):
+    """
+    Spreads the traffic of an MQTTWorker over several brokers. Each route
+    has its own connection, a worker built from the main config updated
+    with the route settings, and carries the topics and filters starting
+    with its prefix (the longest one wins). Others use the main connection.
+
+    The config is a dict:
+        {
+          "routes": [{"name": "control", "prefix": "control/",
+                      "endpoint": "tcp:control.example.com:1883",
+                      "client_id": "...", "username": "...", "app_key": "...",
+                      "qos": 1}],
+          "bridges": [{"from": "control", "to": "default", "filter": "control/alarms/#",
+                       "strip": "control/", "prefix": "site/", "qos": 1}]
+        }
+    Bridged messages are not delivered to the handlers of the source
+    connection. Two bridges forwarding the same topics back and forth loop.
+    """
+
+    def __init__(self, worker, reactor, config, workerClass):
+        self.worker = worker
+        self.reactor = reactor
+        # Rates are computed every route_stats_interval seconds, whoever reads them
+        self.statsInterval = config.get("route_stats_interval", 1.0)
+        self._sampling = None
+        self.default = Route(reactor, DEFAULT, "", worker, 0)
+        self.routes = {DEFAULT: self.default}
+        # Longest prefixes first
+        self.prefixes = []
+
+        inherited = dict((k, v) for k, v in config.items() if not k in NOT_INHERITED)
+        for settings in config.get("routes") or []:
+            name = settings["name"]
+            routeConfig = dict(inherited)
+            routeConfig["client_id"] = "%s-%s" %(config["client_id"], name)
+            routeConfig.update(settings)
+            route = Route(reactor, name, settings["prefix"],
+                          workerClass(reactor, routeConfig), settings.get("qos", 0))
+            self.routes[name] = route
+            self.prefixes.append(route)
+        self.prefixes.sort(key=lambda route: len(route.prefix), reverse=True)
+
+        for settings in config.get("bridges") or []:
+            source = self.routes[settings.get("from") or DEFAULT]
+            target = self.routes[settings.get("to") or DEFAULT]
+            bridge = Bridge(source, target, settings["filter"], settings.get("strip", ""),
+                            settings.get("prefix", ""), settings.get("qos"))
+            source.worker.addBridge(settings["filter"], bridge, settings.get("qos", 0))
+
+    def route(self, topic):
+        for route in self.prefixes:
+            if topic.startswith(route.prefix):
+                return route
+        return self.default
+
+    def start(self):
+        for route in self.prefixes:
+            route.worker.start()
+        self._sampling = LoopingCall(self._sample)
+        self._sampling.clock = self.reactor
+        self._sampling.start(self.statsInterval, now=False)
+
+    def _sample(self):
+        for route in self.routes.values():
+            route.sample()
+
+    def stop(self):
+        """
+        Returns the Deferreds of the routed connections stopping.
+        """
+        if self._sampling is not None and self._sampling.running:
+            self._sampling.stop()
+        self._sampling = None
+        return [route.worker.stopService() for route in self.prefixes]
+
+    def unsubscribeMany(self, handlers):
+        groups = {}
+        for topic, function in handlers:
+            groups.setdefault(self.route(topic).name, []).append((topic, function))
+        return DeferredList([self.routes[name].worker._unsubscribeMany(group)
+                             for name, group in groups.items()], consumeErrors=True)
+
+    def stats(self):
+        return dict((name, route.stats()) for name, route in self.routes.items())
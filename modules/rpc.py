@@ -0,0 +1,187 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import struct
+
+from twisted.internet.defer import Deferred, maybeDeferred
+
+from .messages import encodeString, decodeString
+from .gateway import TimerWheel
+
+# Reply header: request id and status
+REPLY_HEADER = struct.Struct(">IB")
+REQUEST_ID = struct.Struct(">I")
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+class RPCError(Exception):
+    """
+    Error returned by the handler of a request.
+    """
+
+class RPCTimeout(Exception):
+    """
+    No response received in time.
+    """
+
+def encodeRequest(replyTopic, _id, payload):
+    return encodeString(replyTopic) + REQUEST_ID.pack(_id) + payload
+
+def decodeRequest(packet):
+    """
+    Returns the reply topic, request id and payload of a request.
+    """
+    replyTopic, remaining = decodeString(bytearray(packet))
+    _id = REQUEST_ID.unpack_from(remaining)[0]
+    return replyTopic, _id, bytes(remaining[REQUEST_ID.size:])
+
+def encodeReply(_id, status, payload):
+    return REPLY_HEADER.pack(_id, status) + payload
+
+def _toBytes(payload):
+    if payload is None:
+        return b""
+    if isinstance(payload, type(u"")):
+        return payload.encode("utf-8")
+    return payload
+
+class RPCClient(object):
+    """
+    Request / response over MQTT. Every reply comes on a single topic of the
+    client, subscribed once, and is matched with its request by the id
+    carried in the payload. Timeouts are expired by a TimerWheel.
+
+    Without MQTT 5 properties the reply topic and request id travel in front
+    of the request payload, see RPCServer.
+    """
+
+    def __init__(self, worker, reactor, replyTopic=None, qos=0, resolution=0.1):
+        self.worker = worker
+        self.replyTopic = replyTopic or "rpc/%s/reply" %(worker.clientId)
+        self.qos = qos
+        self.nextId = 0
+        # Map request id and [Deferred, timer]
+        self.pending = {}
+        self.timers = TimerWheel(reactor, resolution)
+        self.subscribed = False
+
+        worker.addTopic(self.replyTopic, self._handleReply, qos)
+
+    def joined(self, sessionPresent):
+        # Resubscribed with the other topics when the session is not kept
+        if not sessionPresent:
+            self.subscribed = True
+        self.subscribe()
+
+    def subscribe(self):
+        protocol = self.worker.protocol
+        if self.subscribed or protocol is None or protocol.state != protocol.CONNECTED:
+            return
+        self.subscribed = True
+        protocol.sendSubscribe([(self.replyTopic, self.qos)])
+
+    def request(self, topic, payload, timeout=10.0, qos=0):
+        """
+        Publishes a request on topic. Returns a Deferred firing with the
+        response payload, or failing with RPCError or RPCTimeout.
+        """
+        self.subscribe()
+        if not self.timers.loop.running:
+            self.timers.start()
+
+        _id = self.nextId
+        self.nextId = (self.nextId + 1) & 0xFFFFFFFF
+
+        d = Deferred()
+        timer = self.timers.callLater(timeout, self._expire, _id)
+        self.pending[_id] = [d, timer]
+
+        msg = encodeRequest(self.replyTopic, _id, _toBytes(payload))
+        self.worker.publish(topic, msg, qos).addErrback(self._failed, _id)
+        return d
+
+    def _failed(self, failure, _id):
+        request = self.pending.pop(_id, None)
+        if request is not None:
+            self.timers.cancel(request[1])
+            request[0].errback(failure)
+
+    def _expire(self, _id):
+        request = self.pending.pop(_id, None)
+        if request is not None:
+            request[0].errback(RPCTimeout("No response to request %d" %(_id)))
+
+    def _handleReply(self, payload):
+        if len(payload) < REPLY_HEADER.size:
+            print("ERROR: Invalid RPC reply")
+            return
+        _id, status = REPLY_HEADER.unpack_from(payload)
+        request = self.pending.pop(_id, None)
+        if request is None:
+            # Expired or unknown
+            return
+        d, timer = request
+        self.timers.cancel(timer)
+        body = payload[REPLY_HEADER.size:]
+        if status == STATUS_OK:
+            d.callback(body)
+        else:
+            d.errback(RPCError(body.decode("utf-8", "replace")))
+
+    def stop(self):
+        self.timers.stop()
+        pending, self.pending = self.pending, {}
+        for d, timer in pending.values():
+            d.errback(RPCTimeout("RPC client stopped"))
+
+class RPCServer(object):
+    """
+    Serves the requests of RPCClient published on a topic: handler(payload)
+    returns the response payload, or a Deferred of it. Its errors are sent
+    back to the client as RPCError.
+    """
+
+    def __init__(self, worker, handler, qos=0):
+        self.worker = worker
+        self.handler = handler
+        self.qos = qos
+
+    def handleRequest(self, payload):
+        try:
+            replyTopic, _id, body = decodeRequest(payload)
+        except Exception as e:
+            print("ERROR: Invalid RPC request: %s" %(e))
+            return
+        d = maybeDeferred(self.handler, body)
+        d.addCallbacks(self._reply, self._error, (replyTopic, _id), None,
+                       (replyTopic, _id), None)
+
+    def _reply(self, result, replyTopic, _id):
+        self.worker.publish(replyTopic, encodeReply(_id, STATUS_OK, _toBytes(result)), self.qos)
+
+    def _error(self, failure, replyTopic, _id):
+        print("ERROR: RPC handler failed: %s" %(failure.getErrorMessage()))
+        message = _toBytes(failure.getErrorMessage())
+        self.worker.publish(replyTopic, encodeReply(_id, STATUS_ERROR, message), self.qos)
@@ -0,0 +1,227 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from collections import deque
+
+from .stats import Histogram
+from .utils import TokenBucket, topicMatches
+
+# Payload size credited to a class of weight 1 on each draining round
+QUANTUM = 1024
+
+class QueuedPacket(object):
+    """
+    Packet waiting to be written. data is set to None once written, which
+    lets a later publish on the same topic replace it while it waits.
+    """
+    __slots__ = ("data", "cls", "queuedAt")
+
+    def __init__(self, data, cls=None, queuedAt=None):
+        self.data = data
+        self.cls = cls
+        self.queuedAt = queuedAt
+
+class PriorityClass(object):
+
+    def __init__(self, clock, name, weight=1, bytesPerSecond=0, messagesPerSecond=0):
+        self.name = name
+        self.weight = weight
+        self.quantum = weight * QUANTUM
+        self.deficit = 0
+        self.queue = deque()
+        self.bytesBucket = TokenBucket(clock, bytesPerSecond)
+        self.messagesBucket = TokenBucket(clock, messagesPerSecond)
+
+        self.sent = 0
+        self.sentBytes = 0
+        self.waitTime = Histogram()
+
+class OutboundScheduler(object):
+    """
+    Orders the packets written by an MQTTProtocol by priority class.
+
+    Classes are drained with deficit round robin according to their weight,
+    so a saturated class can not starve the others, and each class as well
+    as the whole connection can be limited in bytes/s and messages/s with
+    token buckets. The scheduler is registered as a streaming producer of
+    the transport: nothing is drained while the socket buffer is full.
+
+    The config is a dict:
+        {
+          "classes": [{"name": "control", "weight": 8},
+                      {"name": "telemetry", "weight": 1, "bytes_per_second": 50000}],
+          "default": "telemetry",
+          "topics": [["alarms/#", "control"]],
+          "bytes_per_second": 0,
+          "messages_per_second": 0
+        }
+    Packets other than PUBLISH always use the first class.
+    """
+
+    def __init__(self, protocol, config, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self.protocol = protocol
+
+        self.classes = []
+        self.byName = {}
+        for c in config["classes"]:
+            cls = PriorityClass(clock, c["name"], c.get("weight", 1),
+                                c.get("bytes_per_second", 0), c.get("messages_per_second", 0))
+            self.classes.append(cls)
+            self.byName[cls.name] = cls
+
+        self.control = self.classes[0]
+        self.default = self.byName[config.get("default", self.classes[-1].name)]
+        self.topics = [(topicFilter, self.byName[name])
+                       for topicFilter, name in config.get("topics", ())]
+
+        self.bytesBucket = TokenBucket(clock, config.get("bytes_per_second", 0))
+        self.messagesBucket = TokenBucket(clock, config.get("messages_per_second", 0))
+
+        self.queued = 0
+        self.paused = False
+        self._timer = None
+
+    def classFor(self, topic=None, priority=None):
+        """
+        Returns the class of a PUBLISH: the given priority class name if any,
+        otherwise the one of the first topic pattern matching.
+        """
+        if priority is not None:
+            return self.byName[priority]
+        if topic is None:
+            return self.control
+        for topicFilter, cls in self.topics:
+            if topicMatches(topicFilter, topic):
+                return cls
+        return self.default
+
+    def write(self, data, cls=None, packet=None):
+        """
+        Writes data or queues it. Returns the QueuedPacket if it had to wait.
+        An already queued packet can be given to be reused.
+        """
+        if cls is None:
+            cls = self.control
+
+        # Nothing waiting: send right away if the limits allow it
+        if not self.queued and not self.paused and not self._delay(cls, len(data)):
+            self._send(cls, data, 0)
+            if packet is not None:
+                packet.data = None
+            return None
+
+        if packet is None:
+            packet = QueuedPacket(data)
+        packet.cls = cls
+        packet.queuedAt = self.clock.seconds()
+        cls.queue.append(packet)
+        self.queued += 1
+        if not self.paused:
+            # The new packet may belong to a class that is not rate limited
+            self._kick()
+        if packet.data is None:
+            return None
+        return packet
+
+    def _kick(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._drain()
+
+    def _delay(self, cls, size):
+        return max(cls.bytesBucket.delay(size), cls.messagesBucket.delay(),
+                   self.bytesBucket.delay(size), self.messagesBucket.delay())
+
+    def _send(self, cls, data, wait):
+        for bucket, amount in ((cls.bytesBucket, len(data)), (cls.messagesBucket, 1),
+                               (self.bytesBucket, len(data)), (self.messagesBucket, 1)):
+            bucket.consume(amount)
+        cls.sent += 1
+        cls.sentBytes += len(data)
+        cls.waitTime.record(wait)
+        self.protocol._send(data)
+
+    def _drain(self):
+        self._timer = None
+        while self.queued and not self.paused:
+            progressed = False
+            wait = None
+            for cls in self.classes:
+                if not cls.queue:
+                    cls.deficit = 0
+                    continue
+                cls.deficit += cls.quantum
+                while cls.queue and not self.paused:
+                    packet = cls.queue[0]
+                    data = packet.data
+                    if len(data) > cls.deficit:
+                        break
+                    delay = self._delay(cls, len(data))
+                    if delay:
+                        wait = delay if wait is None else min(wait, delay)
+                        # No credit piles up while waiting for tokens
+                        cls.deficit = min(cls.deficit, cls.quantum)
+                        break
+                    cls.queue.popleft()
+                    self.queued -= 1
+                    cls.deficit -= len(data)
+                    packet.data = None
+                    self._send(cls, data, self.clock.seconds() - packet.queuedAt)
+                    progressed = True
+
+            if not progressed and wait is not None:
+                # Every class with a packet ready is rate limited
+                self._timer = self.clock.callLater(wait, self._drain)
+                return
+
+    # IPushProducer, the transport pauses us when its buffer is full
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._kick()
+
+    def stopProducing(self):
+        self.paused = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def stats(self):
+        """
+        Returns per class queue depth, sent counters and wait times.
+        """
+        res = {}
+        for cls in self.classes:
+            res[cls.name] = {
+                "depth": len(cls.queue),
+                "sent": cls.sent,
+                "sent_bytes": cls.sentBytes,
+                "wait": cls.waitTime.summary()
+            }
+        return res
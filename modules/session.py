@@ -0,0 +1,349 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from .utils import IdGenerator, isPattern, topicMatches
+from .messages import Pubrel
+
+class Handlers(list):
+    """
+    Local handlers sharing the subscription of a topic, called in turn. A
+    topic with a single handler maps to the function itself.
+    """
+
+    def __call__(self, payload):
+        for function in list(self):
+            function(payload)
+
+class MQTTSession(object):
+    """
+    Client side state of an MQTT session: pending requests, subscribed topics
+    and in flight messages. This is the interface MQTTProtocol expects from
+    its worker, shared by MQTTWorker, the gateway sessions and the asyncio
+    client.
+
+    The maps are only allocated when first needed, which keeps idle sessions
+    small when thousands of them live in one process.
+    """
+
+    __slots__ = ()
+
+    def initSession(self):
+        # Shared by every protocol instance so that packet ids of in flight
+        # messages are never reused after a reconnection
+        self.idGenerator = IdGenerator()
+
+        self.protocol = None
+
+        # In flight subscribe request
+        self.subscribe_requests = None
+
+        # In flight unsubscribe request
+        self.unsubscribe_requests = None
+
+        # Map topic and related function, or Handlers when it has several.
+        # The broker subscription is released with the last handler.
+        self.topics = None
+
+        # Wildcard and shared filters of topics, the only ones scanned when
+        # a topic has no handler of its own
+        self.wildcards = None
+
+        # Map topic and stream consumer factory
+        self.streams = None
+
+        # Map topic filter and MessageBatcher
+        self.batches = None
+
+        # Map topic filter and Bridge forwarding the raw PUBLISH received
+        self.bridges = None
+
+        # Map topic filter and PreFilter of the PUBLISH received
+        self.filters = None
+
+        # Map topic and requested QoS, used to resubscribe
+        self.topics_qos = None
+
+        # Map of publish waiting for ack
+        self.publish_requests = None
+
+        # Map of PUBLISH / PUBREL packets to resend on reconnection
+        self.inflight = None
+
+        # Number of publishes merged into a message still waiting to be sent
+        self.conflated = 0
+
+        # Number of PUBLISH received
+        self.received = 0
+
+        # PacketIdSet of the QoS 2 PUBLISH received and not yet released
+        self.inbound = None
+
+        # Number of QoS 2 PUBLISH received again before their release
+        self.duplicates = 0
+
+    def joined(self, sessionPresent=False):
+        # A new session on the broker side will not release them
+        if not sessionPresent:
+            self.inbound = None
+
+        if not sessionPresent and self.topics_qos:
+            self.protocol.sendSubscribe(list(self.topics_qos.items()))
+
+        if self.inflight:
+            for _id in sorted(self.inflight):
+                msg = self.inflight[_id]
+                if sessionPresent:
+                    self.protocol.resend(msg)
+                elif isinstance(msg, Pubrel):
+                    # The broker acknowledged the PUBLISH with PUBREC but
+                    # forgot its id with the previous session
+                    self.removeInflight(_id)
+                    d = self.getPublishRequest(_id, remove=True)
+                    if d:
+                        d.callback(None)
+                else:
+                    # Published again from scratch on the new session
+                    self.protocol.resend(msg, dup=False)
+
+    def addSubscribeRequest(self, request, d):
+        # XXX To Do: Add boolean to know if a timer should be start
+        if self.subscribe_requests is None:
+            self.subscribe_requests = {}
+        if not request._id in self.subscribe_requests:
+            self.subscribe_requests[request._id] = d
+
+    def getSubscribeRequest(self, _id, remove=False):
+        if not self.subscribe_requests or not _id in self.subscribe_requests:
+            return None
+        if remove:
+            return self.subscribe_requests.pop(_id)
+        return self.subscribe_requests[_id]
+
+    def addUnsubscribeRequest(self, request, d):
+        if self.unsubscribe_requests is None:
+            self.unsubscribe_requests = {}
+        self.unsubscribe_requests[request._id] = d
+
+    def getUnsubscribeRequest(self, _id, remove=False):
+        if not self.unsubscribe_requests or not _id in self.unsubscribe_requests:
+            return None
+        if remove:
+            d = self.unsubscribe_requests.pop(_id)
+            if not self.unsubscribe_requests:
+                self.unsubscribe_requests = None
+            return d
+        return self.unsubscribe_requests[_id]
+
+    def _setQos(self, topic, qos):
+        if self.topics_qos is None:
+            self.topics_qos = {}
+        self.topics_qos[topic] = qos
+
+    def addTopic(self, topic, function, qos=0):
+        """
+        Adds a handler of topic. Returns True when the topic has to be
+        subscribed: first handler, or QoS higher than the current one.
+        """
+        if self.topics is None:
+            self.topics = {}
+        handlers = self.topics.get(topic)
+        if handlers is None:
+            self.topics[topic] = function
+            if isPattern(topic):
+                if self.wildcards is None:
+                    self.wildcards = []
+                self.wildcards.append(topic)
+        elif isinstance(handlers, Handlers):
+            handlers.append(function)
+        else:
+            self.topics[topic] = Handlers((handlers, function))
+
+        current = self.topics_qos.get(topic) if self.topics_qos else None
+        if current is None or qos > current:
+            self._setQos(topic, qos)
+            return True
+        return False
+
+    def removeTopic(self, topic, function=None):
+        """
+        Removes a handler of topic, all of them without function. Returns
+        True when the last one is gone and no stream, batch or bridge still
+        needs the topic subscribed.
+        """
+        handlers = self.topics.get(topic) if self.topics else None
+        if handlers is None:
+            return False
+        if function is not None:
+            if isinstance(handlers, Handlers):
+                if function in handlers:
+                    handlers.remove(function)
+                if len(handlers) > 1:
+                    return False
+                self.topics[topic] = handlers[0]
+                return False
+            if handlers != function:
+                return False
+
+        del self.topics[topic]
+        if not self.topics:
+            self.topics = None
+        if self.wildcards and topic in self.wildcards:
+            self.wildcards.remove(topic)
+            if not self.wildcards:
+                self.wildcards = None
+        if self._isHeld(topic, self.streams, self.batches, self.bridges):
+            return False
+        self._removeQos(topic)
+        return True
+
+    def _isHeld(self, topic, *tables):
+        for table in tables:
+            if table and topic in table:
+                return True
+        return False
+
+    def _removeQos(self, topic):
+        if self.topics_qos and topic in self.topics_qos:
+            del self.topics_qos[topic]
+            if not self.topics_qos:
+                self.topics_qos = None
+
+    def getTopic(self, topic):
+        """
+        Returns the handler of topic: the one of the topic itself and those
+        of every wildcard or shared filter matching it, all called in turn.
+        """
+        if not self.topics:
+            return None
+        function = self.topics.get(topic)
+        if not self.wildcards:
+            return function
+        matching = [self.topics[topicFilter] for topicFilter in self.wildcards
+                    if topicFilter != topic and topicMatches(topicFilter, topic)]
+        if not matching:
+            return function
+        if function is not None:
+            matching.insert(0, function)
+        if len(matching) == 1:
+            return matching[0]
+        return Handlers(matching)
+
+    def addStream(self, topic, factory, qos=0):
+        if self.streams is None:
+            self.streams = {}
+        if not topic in self.streams:
+            self.streams[topic] = factory
+        self._setQos(topic, qos)
+
+    def getStream(self, topic):
+        if not self.streams:
+            return None
+        return self.streams.get(topic)
+
+    def addBatch(self, topicFilter, batcher, qos=0):
+        if self.batches is None:
+            self.batches = {}
+        if not topicFilter in self.batches:
+            self.batches[topicFilter] = batcher
+        self._setQos(topicFilter, qos)
+
+    def getBatch(self, topic):
+        batcher = self.batches.get(topic)
+        if batcher is None:
+            for topicFilter, candidate in self.batches.items():
+                if topicMatches(topicFilter, topic):
+                    return candidate
+        return batcher
+
+    def removeBatch(self, topicFilter):
+        """
+        Removes the batcher of topicFilter, delivering its waiting messages.
+        Returns True when the filter has to be unsubscribed.
+        """
+        batcher = self.batches.pop(topicFilter, None) if self.batches else None
+        if batcher is None:
+            return False
+        batcher.stop()
+        if not self.batches:
+            self.batches = None
+        if self._isHeld(topicFilter, self.topics, self.streams, self.bridges):
+            return False
+        self._removeQos(topicFilter)
+        return True
+
+    def addBridge(self, topicFilter, bridge, qos=0):
+        if self.bridges is None:
+            self.bridges = {}
+        self.bridges[topicFilter] = bridge
+        self._setQos(topicFilter, qos)
+
+    def getBridge(self, topic):
+        bridge = self.bridges.get(topic)
+        if bridge is None:
+            for topicFilter, candidate in self.bridges.items():
+                if topicMatches(topicFilter, topic):
+                    return candidate
+        return bridge
+
+    def addFilter(self, topicFilter, prefilter):
+        if self.filters is None:
+            self.filters = {}
+        self.filters[topicFilter] = prefilter
+
+    def removeFilter(self, topicFilter):
+        if self.filters:
+            self.filters.pop(topicFilter, None)
+            if not self.filters:
+                self.filters = None
+
+    def getFilter(self, topic):
+        prefilter = self.filters.get(topic)
+        if prefilter is None:
+            for topicFilter, candidate in self.filters.items():
+                if topicMatches(topicFilter, topic):
+                    return candidate
+        return prefilter
+
+    def addPublishRequest(self, request, d):
+        # XXX To Do: Add boolean to know if a timer should be start
+        if self.publish_requests is None:
+            self.publish_requests = {}
+        if not request._id in self.publish_requests:
+            self.publish_requests[request._id] = d
+
+    def getPublishRequest(self, _id, remove=False):
+        if not self.publish_requests or not _id in self.publish_requests:
+            return None
+        if remove:
+            return self.publish_requests.pop(_id)
+        return self.publish_requests[_id]
+
+    def addInflight(self, request):
+        if self.inflight is None:
+            self.inflight = {}
+        self.inflight[request._id] = request
+
+    def removeInflight(self, _id):
+        if self.inflight and _id in self.inflight:
+            del self.inflight[_id]
@@ -0,0 +1,112 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import math
+
+class Histogram(object):
+    """
+    HDR style histogram with logarithmic buckets: values are recorded with a
+    constant relative precision, using a memory independent of the number of
+    samples. Histograms can be merged, e.g. across processes.
+    """
+
+    def __init__(self, precision=0.01, lowest=1e-6):
+        self.precision = precision
+        self.lowest = lowest
+        self._logBase = math.log(1 + precision)
+
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        if value < self.lowest:
+            bucket = 0
+        else:
+            bucket = int(math.log(value / self.lowest) / self._logBase)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def _bucketValue(self, bucket):
+        return self.lowest * (1 + self.precision) ** (bucket + 0.5)
+
+    def percentile(self, p):
+        """
+        Returns the value below which p percent of the samples fall.
+        """
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(self._bucketValue(bucket), self.min), self.max)
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def merge(self, other):
+        for bucket, n in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        res = {"count": self.count, "min": self.min, "max": self.max,
+               "mean": self.mean()}
+        for p in percentiles:
+            res["p%s" %(p)] = self.percentile(p)
+        return res
+
+    def toDict(self):
+        return {"precision": self.precision, "lowest": self.lowest,
+                "buckets": self.buckets, "count": self.count,
+                "total": self.total, "min": self.min, "max": self.max}
+
+    @classmethod
+    def fromDict(cls, d):
+        inst = cls(precision=d["precision"], lowest=d["lowest"])
+        # JSON turns the bucket keys into strings
+        inst.buckets = dict((int(k), v) for k, v in d["buckets"].items())
+        inst.count = d["count"]
+        inst.total = d["total"]
+        inst.min = d["min"]
+        inst.max = d["max"]
+        return inst
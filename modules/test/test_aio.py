@@ -0,0 +1,95 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import sys
+
+from twisted.trial import unittest
+
+if sys.version_info >= (3, 5):
+    import asyncio
+    from ..aio import AsyncMQTTClient
+
+CONFIG = {"version": "v311", "client_id": "aio", "username": None, "app_key": None,
+          "reconnect_initial_delay": 0.01, "reconnect_max_delay": 0.02}
+
+class RefusingBroker(object):
+    """
+    Answers every CONNECT with a CONNACK refusing the connection.
+    """
+
+    def __init__(self):
+        self.connects = 0
+
+    def __call__(self):
+        broker = self
+        class Protocol(asyncio.Protocol):
+            def connection_made(self, transport):
+                self.transport = transport
+            def data_received(self, data):
+                broker.connects += 1
+                self.transport.write(b"\x20\x02\x00\x05")
+        return Protocol()
+
+class ReconnectTests(unittest.TestCase):
+
+    if sys.version_info < (3, 5):
+        skip = "asyncio client requires Python 3"
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def _reconnectTasks(self):
+        return [task for task in asyncio.all_tasks(self.loop)
+                if task.get_coro().__name__ == "_reconnect"]
+
+    def test_singleReconnectLoop(self):
+        """
+        Refused attempts do not multiply the reconnection loops.
+        """
+        broker = RefusingBroker()
+        server = self.loop.run_until_complete(
+            self.loop.create_server(broker, "127.0.0.1", 0))
+        port = server.sockets[0].getsockname()[1]
+        config = dict(CONFIG, endpoint="tcp:127.0.0.1:%d" %(port))
+        client = AsyncMQTTClient(config, self.loop)
+
+        try:
+            self.loop.run_until_complete(client.connect())
+        except ConnectionError:
+            pass
+        counts = []
+        for _ in range(20):
+            self.loop.run_until_complete(asyncio.sleep(0.02))
+            counts.append(len(self._reconnectTasks()))
+        self.loop.run_until_complete(client.disconnect())
+        server.close()
+        self.loop.run_until_complete(server.wait_closed())
+        self.assertTrue(broker.connects > 2)
+        self.assertEqual(max(counts), 1)
+
+    def test_notConnected(self):
+        client = AsyncMQTTClient(dict(CONFIG, endpoint="tcp:127.0.0.1:1883"), self.loop)
+        for call in (client.publish("a", b"x"), client.subscribe("a", lambda payload: None)):
+            self.assertRaises(ConnectionError, self.loop.run_until_complete, call)
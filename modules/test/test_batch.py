@@ -0,0 +1,92 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import struct
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from ..batch import MessageBatcher
+
+class MessageBatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.batches = []
+
+    def batcher(self, **kwargs):
+        return MessageBatcher(self.clock, self.batches.append, **kwargs)
+
+    def test_flushOnCount(self):
+        batcher = self.batcher(maxMessages=2, maxDelay=1)
+        batcher.add("a", b"1")
+        self.assertEqual(self.batches, [])
+        batcher.add("b", b"2")
+        self.assertEqual(self.batches, [[("a", b"1"), ("b", b"2")]])
+        self.assertIs(batcher.timer, None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_flushOnDelay(self):
+        batcher = self.batcher(maxMessages=10, maxDelay=1)
+        batcher.add("a", b"1")
+        self.clock.advance(0.5)
+        batcher.add("a", b"2")
+        self.assertEqual(self.batches, [])
+        # The delay runs from the first message of the batch
+        self.clock.advance(0.5)
+        self.assertEqual(self.batches, [[("a", b"1"), ("a", b"2")]])
+        self.assertEqual((batcher.batches, batcher.messages), (1, 2))
+
+    def test_stop(self):
+        batcher = self.batcher(maxMessages=10, maxDelay=1)
+        batcher.add("a", b"1")
+        batcher.stop()
+        self.assertEqual(self.batches, [[("a", b"1")]])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class ColumnarBatchTests(unittest.TestCase):
+
+    if numpy is None:
+        skip = "NumPy is not installed"
+
+    def test_columns(self):
+        batches = []
+        layout = [("timestamp", "<f8"), ("value", "<f4")]
+        batcher = MessageBatcher(Clock(), batches.append, 3, 1, layout)
+        batcher.add("s/2", struct.pack("<df", 1.0, 10.0))
+        batcher.add("s/1", b"short")
+        batcher.add("s/2", struct.pack("<df", 2.0, 20.0))
+
+        batch = batches[0]
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch.dropped, 1)
+        self.assertEqual(batch.topics, ["s/2"])
+        self.assertEqual(batch["timestamp"].tolist(), [1.0, 2.0])
+        self.assertEqual(batch["value"].tolist(), [10.0, 20.0])
+        self.assertEqual(batch.topicIndex.tolist(), [0, 0])
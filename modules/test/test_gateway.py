@@ -0,0 +1,48 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from ..gateway import SessionManager, Session
+
+class DisconnectedSessionTests(unittest.TestCase):
+
+    def setUp(self):
+        manager = SessionManager(Clock(), {"endpoint": "tcp:127.0.0.1:1883", "version": "v311"})
+        self.session = Session(manager, "device-1")
+
+    def test_publish(self):
+        d = self.session.publish("a/b", b"x", 1)
+        return self.assertFailure(d, Exception)
+
+    def test_subscribe(self):
+        d = self.session.subscribe("a/b", lambda payload: None, 1)
+        return self.assertFailure(d, Exception)
+
+    def test_unsubscribe(self):
+        self.session.addTopic("a/b", lambda payload: None)
+        d = self.session.unsubscribe("a/b")
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertFalse(self.session.topics)
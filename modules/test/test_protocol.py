@@ -0,0 +1,353 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+try:
+    from twisted.internet.testing import StringTransport
+except ImportError:
+    from twisted.test.proto_helpers import StringTransport
+
+from ..protocol import MQTTProtocol
+from ..session import MQTTSession
+from ..messages import Publish, Puback, Pubrel, getLength, decodeLength
+from ..scheduler import OutboundScheduler
+from ..tracing import MAGIC, TRAILER
+
+class FakeWorker(MQTTSession):
+    """
+    Session without connection handling, for the protocol alone.
+    """
+    maxPacketSize = 0
+    recorder = None
+
+    def __init__(self):
+        self.initSession()
+
+    def disconnected(self, protocol, reason):
+        pass
+
+class Consumer(object):
+
+    def __init__(self, topic, length):
+        self.topic = topic
+        self.length = length
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+
+    def close(self):
+        self.closed = True
+
+def splitPackets(data):
+    packets = []
+    while data:
+        lenLen = getLength(data)
+        total = decodeLength(data[1:lenLen+1]) + lenLen + 1
+        packets.append(data[:total])
+        data = data[total:]
+    return packets
+
+def connectedProtocol(worker):
+    protocol = MQTTProtocol()
+    protocol.worker = worker
+    transport = StringTransport()
+    protocol.makeConnection(transport)
+    protocol.state = protocol.CONNECTED
+    return protocol, transport
+
+class StreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = FakeWorker()
+        self.protocol, self.transport = connectedProtocol(self.worker)
+        self.consumers = []
+        self.worker.addStream("files/a", self.factory, 1)
+        self.payload = b"x" * 500
+
+    def factory(self, topic, length):
+        consumer = Consumer(topic, length)
+        self.consumers.append(consumer)
+        return consumer
+
+    def publish(self, qos=0, _id=None):
+        return Publish(_id=_id, topic="files/a", payload=self.payload,
+                       qos=qos, retain=False, dup=False).pack()
+
+    def assertStreamed(self):
+        self.assertEqual(len(self.consumers), 1)
+        consumer = self.consumers[0]
+        self.assertEqual(consumer.topic, "files/a")
+        self.assertEqual(consumer.length, len(self.payload))
+        self.assertEqual(b"".join(consumer.chunks), self.payload)
+        self.assertTrue(consumer.closed)
+
+    def test_wholePacket(self):
+        """
+        A PUBLISH received in a single read is streamed too.
+        """
+        self.protocol.dataReceived(self.publish())
+        self.assertStreamed()
+
+    def test_splitPacket(self):
+        data = self.publish()
+        self.protocol.dataReceived(data[:20])
+        self.assertEqual(len(self.consumers), 1)
+        self.assertFalse(self.consumers[0].closed)
+        self.protocol.dataReceived(data[20:])
+        self.assertStreamed()
+
+    def test_wholePacketAcknowledged(self):
+        self.protocol.dataReceived(self.publish(qos=1, _id=3))
+        self.assertStreamed()
+        self.assertEqual(self.transport.value(), b"\x40\x02\x00\x03")
+
+    def test_splitPacketAcknowledgedOnClose(self):
+        data = self.publish(qos=1, _id=4)
+        self.protocol.dataReceived(data[:20])
+        self.assertEqual(self.transport.value(), b"")
+        self.protocol.dataReceived(data[20:])
+        self.assertStreamed()
+        self.assertEqual(self.transport.value(), b"\x40\x02\x00\x04")
+
+    def test_splitPacketDuplicate(self):
+        """
+        A QoS 2 PUBLISH streamed again before its PUBREL is acknowledged
+        but not handed to a new consumer.
+        """
+        data = self.publish(qos=2, _id=5)
+        for i in range(2):
+            self.protocol.dataReceived(data[:20])
+            self.protocol.dataReceived(data[20:])
+        self.assertStreamed()
+        self.assertEqual(self.worker.duplicates, 1)
+        self.assertEqual(self.transport.value(), b"\x50\x02\x00\x05" * 2)
+
+        self.transport.clear()
+        self.protocol.dataReceived(Pubrel(5).pack())
+        self.assertEqual(self.transport.value(), b"\x70\x02\x00\x05")
+        self.protocol.dataReceived(data)
+        self.assertEqual(len(self.consumers), 2)
+
+    def test_followingPacket(self):
+        """
+        A packet following a streamed one in the same read is dispatched.
+        """
+        received = []
+        self.worker.addTopic("other", received.append)
+        other = Publish(_id=None, topic="other", payload=b"y", qos=0,
+                        retain=False, dup=False).pack()
+        data = self.publish()
+        self.protocol.dataReceived(data[:20])
+        self.protocol.dataReceived(data[20:] + other)
+        self.assertStreamed()
+        self.assertEqual(received, [b"y"])
+
+class ReceiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = FakeWorker()
+        self.protocol, self.transport = connectedProtocol(self.worker)
+        self.received = []
+        self.worker.addTopic("t", self.received.append, 2)
+
+    def publish(self, payload, qos, _id, dup=False):
+        self.protocol.dataReceived(Publish(_id=_id, topic="t", payload=payload, qos=qos,
+                                           retain=False, dup=dup).pack())
+
+    def test_qos1(self):
+        self.publish(b"a", 1, 3)
+        self.assertEqual(self.received, [b"a"])
+        self.assertEqual(self.transport.value(), b"\x40\x02\x00\x03")
+
+    def test_qos2(self):
+        self.publish(b"a", 2, 3)
+        self.assertEqual(self.received, [b"a"])
+        self.assertEqual(self.transport.value(), b"\x50\x02\x00\x03")
+
+        self.transport.clear()
+        self.protocol.dataReceived(Pubrel(3).pack())
+        self.assertEqual(self.transport.value(), b"\x70\x02\x00\x03")
+
+    def test_qos2Duplicate(self):
+        """
+        A QoS 2 PUBLISH received again before its PUBREL is acknowledged
+        without being delivered twice, its id is free again once released.
+        """
+        self.publish(b"a", 2, 3)
+        self.publish(b"a", 2, 3, dup=True)
+        self.assertEqual(self.received, [b"a"])
+        self.assertEqual(self.worker.duplicates, 1)
+        self.assertEqual(self.transport.value(), b"\x50\x02\x00\x03" * 2)
+
+        self.protocol.dataReceived(Pubrel(3).pack())
+        self.publish(b"b", 2, 3)
+        self.assertEqual(self.received, [b"a", b"b"])
+
+class ConflationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.worker = FakeWorker()
+        self.protocol, self.transport = connectedProtocol(self.worker)
+        # One message per second: the publishes after the first one wait
+        self.protocol.scheduler = OutboundScheduler(
+            self.protocol, {"classes": [{"name": "data", "messages_per_second": 1}]},
+            self.clock)
+        self.protocol.publish("t", b"first")
+
+    def sent(self):
+        return [Publish.unpack(packet)
+                for packet in splitPackets(bytearray(self.transport.value()))]
+
+    def test_sameQos(self):
+        self.protocol.publish("t", b"a", conflate=True)
+        self.protocol.publish("t", b"b", conflate=True)
+        self.clock.advance(1)
+        self.assertEqual([msg.payload for msg in self.sent()], [b"first", b"b"])
+        self.assertEqual(self.worker.conflated, 1)
+
+    def test_qosUpgraded(self):
+        """
+        A QoS 1 publish conflated into a queued QoS 0 one is sent with QoS 1
+        and acknowledged.
+        """
+        d0 = self.protocol.publish("t", b"a", qos=0, conflate=True)
+        d1 = self.protocol.publish("t", b"b", qos=1, conflate=True)
+        self.clock.advance(1)
+        msg = self.sent()[-1]
+        self.assertEqual((msg.payload, msg.qos), (b"b", 1))
+        self.assertIsNot(msg._id, None)
+        self.assertNoResult(d1)
+
+        self.protocol.dataReceived(Puback(msg._id).pack())
+        self.successResultOf(d1)
+        self.successResultOf(d0)
+        self.assertFalse(self.worker.inflight)
+
+    def test_higherQosKept(self):
+        d1 = self.protocol.publish("t", b"a", qos=1, conflate=True)
+        d0 = self.protocol.publish("t", b"b", qos=0, conflate=True)
+        self.successResultOf(d0)
+        self.clock.advance(1)
+        msg = self.sent()[-1]
+        self.assertEqual((msg.payload, msg.qos), (b"b", 1))
+        self.protocol.dataReceived(Puback(msg._id).pack())
+        self.successResultOf(d1)
+
+    def test_retainNotMerged(self):
+        self.protocol.publish("t", b"a", retain=True, conflate=True)
+        self.protocol.publish("t", b"b", conflate=True)
+        self.clock.advance(1)
+        self.clock.advance(1)
+        self.assertEqual([(msg.payload, msg.retain) for msg in self.sent()],
+                         [(b"first", False), (b"a", True), (b"b", False)])
+
+class ResumeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = FakeWorker()
+        self.protocol, self.transport = connectedProtocol(self.worker)
+        self.worker.protocol = self.protocol
+        self.publish = Publish(_id=5, topic="t", payload=b"x", qos=1, retain=False, dup=False)
+        self.published = Deferred()
+        self.released = Deferred()
+        self.worker.addPublishRequest(self.publish, self.published)
+        self.worker.addInflight(self.publish)
+        self.worker.addPublishRequest(Pubrel(6), self.released)
+        self.worker.addInflight(Pubrel(6))
+
+    def test_sessionPresent(self):
+        self.worker.joined(True)
+        packets = splitPackets(bytearray(self.transport.value()))
+        self.assertTrue(Publish.unpack(packets[0]).dup)
+        self.assertEqual(bytes(packets[1]), b"\x62\x02\x00\x06")
+        self.assertNoResult(self.released)
+
+    def test_newSession(self):
+        """
+        On a new session the PUBLISH are sent again as new ones and the
+        PUBREL dropped, their publish being complete.
+        """
+        self.worker.joined(False)
+        packets = splitPackets(bytearray(self.transport.value()))
+        self.assertEqual(len(packets), 1)
+        msg = Publish.unpack(packets[0])
+        self.assertEqual((msg._id, msg.dup), (5, False))
+        self.successResultOf(self.released)
+        self.assertNoResult(self.published)
+        self.assertEqual(list(self.worker.inflight), [5])
+
+class SharedFilterTests(unittest.TestCase):
+    """
+    Removing the last handler of a topic keeps the broker subscription while
+    a stream, batch or bridge still uses the same filter.
+    """
+
+    def setUp(self):
+        self.worker = FakeWorker()
+        self.protocol, self.transport = connectedProtocol(self.worker)
+        self.worker.addTopic("t/#", lambda payload: None, 1)
+
+    def assertKept(self):
+        self.successResultOf(self.protocol.unsubscribe("t/#"))
+        self.assertEqual(self.transport.value(), b"")
+        self.assertEqual(self.worker.topics_qos, {"t/#": 1})
+
+    def test_stream(self):
+        self.worker.addStream("t/#", lambda topic, length: None, 1)
+        self.assertKept()
+
+    def test_batch(self):
+        self.worker.addBatch("t/#", object(), 1)
+        self.assertKept()
+
+    def test_bridge(self):
+        self.worker.addBridge("t/#", object(), 1)
+        self.assertKept()
+
+    def test_lastUser(self):
+        self.protocol.unsubscribe("t/#")
+        self.assertEqual(bytearray(self.transport.value())[0], 0xa2)
+        self.assertIs(self.worker.topics_qos, None)
+
+class TrailerTests(unittest.TestCase):
+
+    def test_strippedWithoutTracer(self):
+        """
+        A traced message reaches the handlers of a receiver not tracing
+        without its trailer.
+        """
+        worker = FakeWorker()
+        protocol, transport = connectedProtocol(worker)
+        received = []
+        worker.addTopic("t", received.append)
+        payload = b"data" + TRAILER.pack(1, 1.0, 0, 0, 0, MAGIC)
+        protocol.dataReceived(Publish(_id=None, topic="t", payload=payload, qos=0,
+                                      retain=False, dup=False).pack())
+        self.assertEqual(received, [b"data"])
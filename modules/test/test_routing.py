@@ -0,0 +1,82 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from collections import deque
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from ..routing import Router
+
+class FakeWorker(object):
+
+    def __init__(self, reactor=None, config=None):
+        self.config = config
+        self.received = 0
+        self.offline = deque()
+        self.started = False
+
+    def start(self):
+        self.started = True
+
+    def stopService(self):
+        return succeed(None)
+
+    def _publish(self, topic, message, qos=0, priority=None, conflate=False):
+        return succeed(None)
+
+class RouterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.worker = FakeWorker()
+        config = {"client_id": "main", "route_stats_interval": 1.0,
+                  "routes": [{"name": "control", "prefix": "control/", "qos": 1}]}
+        self.router = Router(self.worker, self.clock, config, FakeWorker)
+        self.router.start()
+
+    def tearDown(self):
+        self.router.stop()
+
+    def test_route(self):
+        self.assertEqual(self.router.route("control/a").name, "control")
+        self.assertEqual(self.router.route("telemetry/a").name, "default")
+        self.assertEqual(self.router.routes["control"].worker.config["client_id"],
+                         "main-control")
+
+    def test_ratesNotResetByReaders(self):
+        """
+        Reading the stats does not change the rates seen by other readers.
+        """
+        for i in range(10):
+            self.router.route("control/a").publish("control/a", b"x")
+        self.clock.advance(1.0)
+        first = self.router.stats()["control"]
+        second = self.router.stats()["control"]
+        self.assertEqual(first["publish_rate"], 10.0)
+        self.assertEqual(second["publish_rate"], 10.0)
+
+        self.clock.advance(1.0)
+        self.assertEqual(self.router.stats()["control"]["publish_rate"], 0.0)
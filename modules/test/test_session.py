@@ -0,0 +1,72 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from twisted.trial import unittest
+
+from ..session import MQTTSession
+
+class Session(MQTTSession):
+
+    def __init__(self):
+        self.initSession()
+
+class TopicTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = Session()
+        self.received = []
+
+    def handler(self, name):
+        return lambda payload: self.received.append((name, payload))
+
+    def test_exact(self):
+        self.session.addTopic("a/b", self.handler("exact"))
+        self.assertIs(self.session.wildcards, None)
+        self.session.getTopic("a/b")(b"x")
+        self.assertEqual(self.received, [("exact", b"x")])
+        self.assertIs(self.session.getTopic("a/c"), None)
+
+    def test_overlapping(self):
+        """
+        Every filter matching the topic reaches its handlers.
+        """
+        self.session.addTopic("a/b", self.handler("exact"))
+        self.session.addTopic("a/+", self.handler("plus"))
+        self.session.addTopic("a/#", self.handler("hash"))
+        self.session.addTopic("c/#", self.handler("other"))
+        self.session.getTopic("a/b")(b"x")
+        self.assertEqual(sorted(self.received),
+                         [("exact", b"x"), ("hash", b"x"), ("plus", b"x")])
+
+    def test_shared(self):
+        self.session.addTopic("$share/g/a/b", self.handler("shared"))
+        self.assertEqual(self.session.wildcards, ["$share/g/a/b"])
+        self.session.getTopic("a/b")(b"x")
+        self.assertEqual(self.received, [("shared", b"x")])
+
+    def test_removed(self):
+        self.session.addTopic("a/+", self.handler("plus"))
+        self.session.removeTopic("a/+")
+        self.assertIs(self.session.wildcards, None)
+        self.assertIs(self.session.getTopic("a/b"), None)
@@ -0,0 +1,93 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from ..threads import ThreadPublisher
+
+class ThreadClock(Clock):
+
+    def callFromThread(self, f, *args, **kwargs):
+        self.callLater(0, f, *args, **kwargs)
+
+class FakeWorker(object):
+
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, message, qos=None, priority=None, conflate=False):
+        if qos is not None and not 0 <= qos < 3:
+            raise Exception("Invalid QOS")
+        self.published.append((topic, message))
+        return succeed(None)
+
+class ThreadPublisherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = ThreadClock()
+        self.worker = FakeWorker()
+        self.publisher = ThreadPublisher(self.worker, self.clock, maxSize=10, batchSize=2)
+
+    def test_batchedWakeups(self):
+        futures = [self.publisher.publish("t", b"%d" %(i), block=False) for i in range(5)]
+        self.assertEqual(self.publisher.wakeups, 1)
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.assertEqual(len(self.worker.published), 5)
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertFalse(self.publisher.scheduled)
+
+    def test_failedPublish(self):
+        """
+        A publish raising does not stall the rest of the queue.
+        """
+        bad = self.publisher.publish("t", b"bad", qos=3, block=False)
+        futures = [self.publisher.publish("t", b"%d" %(i), qos=1, block=False) for i in range(3)]
+        self.clock.advance(0)
+        self.clock.advance(0)
+        self.assertRaises(Exception, bad.result, 0)
+        for future in futures:
+            self.assertEqual(future.result(0), None)
+        self.assertEqual(self.publisher.published, 4)
+        self.assertFalse(self.publisher.scheduled)
+
+    def test_queueFull(self):
+        futures = [self.publisher.publish("t", b"x", block=False) for i in range(11)]
+        self.assertRaises(Exception, futures[-1].result, 0)
+        self.assertFalse(futures[0].done())
+
+    def test_restarted(self):
+        """
+        A stopped publisher accepts publishes again once started.
+        """
+        self.publisher.stop()
+        self.assertRaises(Exception, self.publisher.publish("t", b"x", block=False).result, 0)
+        self.publisher.start()
+        future = self.publisher.publish("t", b"y", block=False)
+        self.clock.advance(0)
+        self.assertEqual(future.result(0), None)
+        self.assertEqual(self.worker.published, [("t", b"y")])
@@ -0,0 +1,83 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from ..worker import MQTTWorker
+from .test_protocol import connectedProtocol, splitPackets
+
+CONFIG = {
+    "endpoint": "tcp:localhost:1883",
+    "version": "v311",
+    "client_id": "test",
+    "username": None,
+    "app_key": None,
+}
+
+class DisconnectedWorkerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.worker = MQTTWorker(Clock(), dict(CONFIG))
+
+    def test_subscribeBatch(self):
+        """
+        A batch subscribed while disconnected is subscribed once joined.
+        """
+        self.successResultOf(self.worker.subscribeBatch("s/#", lambda batch: None, qos=1))
+        self.assertIn("s/#", self.worker.batches)
+
+        protocol, transport = connectedProtocol(self.worker)
+        self.worker.protocol = protocol
+        self.worker.joined(False)
+        packets = splitPackets(bytearray(transport.value()))
+        self.assertEqual(len(packets), 1)
+        self.assertEqual(packets[0][0], 0x82)
+        self.assertIn(b"s/#", bytes(packets[0]))
+
+class RoutedWorkerTests(unittest.TestCase):
+    """
+    Batches and filters go to the connection routing their topic.
+    """
+
+    def setUp(self):
+        config = dict(CONFIG)
+        config["routes"] = [{"name": "control", "prefix": "control/",
+                             "endpoint": "tcp:localhost:1884"}]
+        self.worker = MQTTWorker(Clock(), config)
+        self.control = self.worker.router.routes["control"].worker
+
+    def test_subscribeBatch(self):
+        self.worker.subscribeBatch("control/#", lambda batch: None)
+        self.worker.subscribeBatch("data/#", lambda batch: None)
+        self.assertEqual(list(self.control.batches), ["control/#"])
+        self.assertEqual(list(self.worker.batches), ["data/#"])
+
+        self.worker.unsubscribeBatch("control/#")
+        self.assertIs(self.control.batches, None)
+
+    def test_filterTopic(self):
+        prefilter = self.worker.filterTopic("control/#", rate=10)
+        self.assertIs(self.control.getFilter("control/a"), prefilter)
+        self.assertIs(self.worker.filters, None)
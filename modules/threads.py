@@ -0,0 +1,179 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import threading
+import time
+
+from collections import deque
+
+from twisted.internet.defer import maybeDeferred
+from twisted.python import threadable
+
+class PublishFuture(object):
+    """
+    Result of a publish made from another thread, set from the reactor
+    thread once the message is written (QoS 0) or acknowledged (QoS 1/2).
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def setResult(self, result):
+        self._result = result
+        self._event.set()
+
+    def setException(self, exception):
+        self._exception = exception
+        self._event.set()
+
+    def _setFailure(self, failure):
+        self.setException(failure.value)
+
+    def done(self):
+        return self._event.is_set()
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise Exception("Publish not completed after %s seconds" %(timeout))
+        return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+class ThreadPublisher(object):
+    """
+    Hands publishes made from other threads over to the reactor thread.
+
+    Messages are appended to a deque and the reactor is woken only when no
+    drain is already scheduled, so a burst of publishes costs one
+    callFromThread instead of one per message. The reactor publishes up
+    to batchSize messages per iteration through MQTTWorker.publish. When
+    maxSize messages are waiting, the calling thread blocks until the queue
+    drains or the future fails at once without block.
+    """
+
+    def __init__(self, worker, reactor, maxSize=10000, batchSize=500):
+        self.worker = worker
+        self.reactor = reactor
+        self.maxSize = maxSize
+        self.batchSize = batchSize
+
+        self.queue = deque()
+        self.lock = threading.Lock()
+        self.notFull = threading.Condition(self.lock)
+        self.scheduled = False
+        self.stopped = False
+
+        self.wakeups = 0
+        self.published = 0
+        self.blocked = 0
+
+    def publish(self, topic, message, qos=None, priority=None, conflate=False,
+                block=True, timeout=None):
+        """
+        Queues a publish from any thread, returns a PublishFuture.
+        """
+        future = PublishFuture()
+        # The reactor thread must never wait on itself
+        block = block and not threadable.isInIOThread()
+
+        with self.lock:
+            if self.stopped:
+                future.setException(Exception("Publisher stopped"))
+                return future
+            if self.maxSize and len(self.queue) >= self.maxSize:
+                if not block:
+                    future.setException(Exception("Publish queue full"))
+                    return future
+                self.blocked += 1
+                self._waitNotFull(timeout)
+                if len(self.queue) >= self.maxSize or self.stopped:
+                    future.setException(Exception("Publish queue full"))
+                    return future
+
+            self.queue.append((topic, message, qos, priority, conflate, future))
+            wakeup = not self.scheduled
+            if wakeup:
+                self.scheduled = True
+                self.wakeups += 1
+
+        if wakeup:
+            self.reactor.callFromThread(self._drain)
+        return future
+
+    def _waitNotFull(self, timeout):
+        # Condition.wait does not tell whether it timed out on Python 2
+        deadline = None if timeout is None else time.time() + timeout
+        while len(self.queue) >= self.maxSize and not self.stopped:
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return
+            self.notFull.wait(remaining)
+
+    def _drain(self):
+        with self.lock:
+            batch = [self.queue.popleft() for _ in range(min(self.batchSize, len(self.queue)))]
+            more = bool(self.queue)
+            if not more:
+                self.scheduled = False
+            self.notFull.notify_all()
+
+        # A publish failing at once (invalid QoS, unknown priority) only
+        # fails its own future
+        for topic, message, qos, priority, conflate, future in batch:
+            d = maybeDeferred(self.worker.publish, topic, message, qos,
+                              priority=priority, conflate=conflate)
+            d.addCallbacks(future.setResult, future._setFailure)
+        self.published += len(batch)
+
+        # Lets the reactor serve the network between two batches
+        if more:
+            self.reactor.callLater(0, self._drain)
+
+    def start(self):
+        """
+        Accepts publishes again after stop, when the worker is restarted.
+        """
+        with self.lock:
+            self.stopped = False
+
+    def stop(self):
+        """
+        Fails the waiting publishes and the later ones, until start.
+        """
+        with self.lock:
+            self.stopped = True
+            pending, self.queue = self.queue, deque()
+            self.notFull.notify_all()
+        for entry in pending:
+            entry[-1].setException(Exception("Publisher stopped"))
+
+    def stats(self):
+        return {"queued": len(self.queue), "published": self.published,
+                "wakeups": self.wakeups, "blocked": self.blocked}
@@ -0,0 +1,263 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+from OpenSSL import SSL
+
+from zope.interface import implementer
+
+from twisted.internet import ssl
+from twisted.internet.defer import succeed
+from twisted.internet.endpoints import wrapClientTLS
+from twisted.internet.interfaces import (IStreamClientEndpoint,
+                                         IOpenSSLClientConnectionCreator,
+                                         IHandshakeListener)
+from twisted.internet.protocol import Factory, Protocol
+
+from .stats import Histogram
+
+def tlsOptions(hostname, config):
+    """
+    Builds the client TLS options from the "tls" worker config: ca_file (PEM
+    trust root, platform trust when missing), cert_file and key_file (PEM
+    client certificate).
+    """
+    trustRoot = None
+    if config.get("ca_file"):
+        with open(config["ca_file"], "rb") as f:
+            trustRoot = ssl.Certificate.loadPEM(f.read())
+
+    clientCertificate = None
+    if config.get("cert_file"):
+        with open(config["cert_file"], "rb") as f:
+            data = f.read()
+        if config.get("key_file"):
+            with open(config["key_file"], "rb") as f:
+                data += b"\n" + f.read()
+        clientCertificate = ssl.PrivateCertificate.loadPEM(data)
+
+    return ssl.optionsForClientTLS(u"%s" %(hostname,), trustRoot=trustRoot,
+                                   clientCertificate=clientCertificate)
+
+def _sessionReused(connection):
+    # pyOpenSSL does not expose SSL_session_reused, use its binding if present
+    try:
+        from OpenSSL._util import lib
+        return bool(lib.SSL_session_reused(connection._ssl))
+    except Exception:
+        return None
+
+@implementer(IHandshakeListener)
+class _TLSConnection(Protocol):
+    """
+    Forwards a TLS connection to the protocol of the client. A standby
+    connection has no protocol until it is handed over by connect().
+    """
+
+    def __init__(self, endpoint, protocol=None):
+        self.endpoint = endpoint
+        self.protocol = protocol
+        self.startedAt = None
+        self.handshakeDone = False
+        self._sessionSaved = False
+
+    def connectionMade(self):
+        self.startedAt = self.endpoint.reactor.seconds()
+        if self.protocol is not None:
+            self.protocol.makeConnection(self.transport)
+
+    def handshakeCompleted(self):
+        self.handshakeDone = True
+        self.endpoint._handshakeCompleted(self)
+
+    def attach(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self.transport)
+
+    def dataReceived(self, data):
+        # TLS 1.3 tickets come after the handshake, with the first records
+        if not self._sessionSaved:
+            self._sessionSaved = True
+            self.endpoint._saveSession(self)
+        if self.protocol is not None:
+            self.protocol.dataReceived(data)
+
+    def connectionLost(self, reason):
+        if self.handshakeDone:
+            self.endpoint._saveSession(self)
+        else:
+            # The cached session may be the cause of the failure
+            self.endpoint.session = None
+        if self.protocol is not None:
+            self.protocol.connectionLost(reason)
+        else:
+            self.endpoint._standbyLost(self)
+
+class _TLSConnectionFactory(Factory):
+
+    def __init__(self, endpoint, factory=None):
+        self.endpoint = endpoint
+        self.factory = factory
+
+    def buildProtocol(self, addr):
+        protocol = None
+        if self.factory is not None:
+            protocol = self.factory.buildProtocol(addr)
+            if protocol is None:
+                return None
+        return _TLSConnection(self.endpoint, protocol)
+
+@implementer(IStreamClientEndpoint, IOpenSSLClientConnectionCreator)
+class TLSClientEndpoint(object):
+    """
+    TLS client endpoint for ClientService reconnections: the TLS session of
+    the last connection is offered again to skip the full handshake, and a
+    standby connection can be kept handshaked to take over at once when the
+    current one is lost. The handshake time of each connection is recorded.
+    """
+
+    def __init__(self, reactor, endpoint, options, reuse=True, standby=False,
+                 standbyDelay=1.0):
+        self.reactor = reactor
+        self.endpoint = wrapClientTLS(self, endpoint)
+        self.options = options
+        self.reuse = reuse
+
+        # Last session of the broker, None until the first handshake
+        self.session = None
+
+        self.standby = standby
+        self.standbyDelay = standbyDelay
+        self._standby = None
+        self._warming = False
+        self._timer = None
+        self._stopped = False
+
+        self.handshakes = Histogram()
+        self.resumed = 0
+        self.takeovers = 0
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        connection = self.options.clientConnectionForTLS(tlsProtocol)
+        if self.reuse and self.session is not None:
+            connection.set_session(self.session)
+        return connection
+
+    def connect(self, protocolFactory):
+        self._stopped = False
+        conn, self._standby = self._standby, None
+        if conn is not None:
+            protocol = protocolFactory.buildProtocol(conn.transport.getPeer())
+            if protocol is not None:
+                print("INFO: TLS standby connection taking over")
+                self.takeovers += 1
+                conn.attach(protocol)
+                self._scheduleStandby(0)
+                return succeed(protocol)
+
+        d = self.endpoint.connect(_TLSConnectionFactory(self, protocolFactory))
+        d.addCallback(self._connected)
+        return d
+
+    def _connected(self, conn):
+        self._scheduleStandby(0)
+        return conn.protocol
+
+    def standbyReady(self):
+        return self._standby is not None
+
+    def stop(self):
+        """
+        Stops keeping a standby connection and closes the idle one.
+        """
+        self._stopped = True
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        conn, self._standby = self._standby, None
+        if conn is not None:
+            conn.transport.loseConnection()
+
+    def _scheduleStandby(self, delay):
+        if not self.standby or self._stopped or self._warming or self._standby is not None:
+            return
+        if self._timer is not None and self._timer.active():
+            return
+        self._timer = self.reactor.callLater(delay, self._warm)
+
+    def _warm(self):
+        self._timer = None
+        if self._stopped or self._warming or self._standby is not None:
+            return
+        self._warming = True
+        d = self.endpoint.connect(_TLSConnectionFactory(self))
+        d.addErrback(self._warmFailed)
+
+    def _warmFailed(self, failure):
+        print("ERROR: TLS standby connection failed: %s" %(failure.getErrorMessage()))
+        self._warming = False
+        self._scheduleStandby(self.standbyDelay)
+
+    def _standbyLost(self, conn):
+        if self._standby is conn:
+            self._standby = None
+        if not conn.handshakeDone:
+            self._warming = False
+        self._scheduleStandby(self.standbyDelay)
+
+    def _handshakeCompleted(self, conn):
+        elapsed = self.reactor.seconds() - conn.startedAt
+        self.handshakes.record(elapsed)
+        connection = conn.transport.getHandle()
+        resumed = _sessionReused(connection)
+        if resumed:
+            self.resumed += 1
+        self._saveSession(conn)
+
+        if conn.protocol is None:
+            print("INFO: TLS standby handshake in %.1f ms (resumed: %s)" %(elapsed * 1000, resumed))
+            self._warming = False
+            if self._stopped:
+                conn.transport.loseConnection()
+            else:
+                self._standby = conn
+        else:
+            print("INFO: TLS handshake in %.1f ms (resumed: %s)" %(elapsed * 1000, resumed))
+
+    def _saveSession(self, conn):
+        if not self.reuse:
+            return
+        try:
+            session = conn.transport.getHandle().get_session()
+        except SSL.Error:
+            return
+        if session is not None:
+            self.session = session
+
+    def stats(self):
+        return {
+            "handshakes": self.handshakes.count,
+            "resumed": self.resumed,
+            "takeovers": self.takeovers,
+            "handshake_time": self.handshakes.summary()
+        }
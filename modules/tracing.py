@@ -0,0 +1,172 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import random
+import struct
+import time
+
+from twisted.internet.task import LoopingCall
+
+from .stats import Histogram
+
+# Trailer appended to the payload of traced messages: trace id, publish,
+# encode, socket write and broker times, and a magic marking the trailer.
+# MQTT 3.1.1 has no user properties to carry them.
+MAGIC = b"\xffMQTRC\x01\xff"
+TRAILER = struct.Struct(">Q4d8s")
+
+PUBLISHED = 1
+ENCODED = 2
+SENT = 3
+BROKER = 4
+
+# Hops measured between two stamps, in path order
+HOPS = ("encode", "queue", "broker", "network", "decode", "dispatch", "handler", "total")
+
+def stamp(data, field, value=None):
+    """
+    Sets a time of the trailer ending data, returns the new data. Data
+    without trailer is returned as is.
+    """
+    if not data.endswith(MAGIC):
+        return data
+    fields = list(TRAILER.unpack_from(data, len(data) - TRAILER.size))
+    fields[field] = time.time() if value is None else value
+    return data[:-TRAILER.size] + TRAILER.pack(*fields)
+
+def strip(data):
+    """
+    Returns data without its trailer, for the receivers not tracing: a
+    traced message may come from another publisher or through a bridge.
+    """
+    if not data.endswith(MAGIC) or len(data) < TRAILER.size:
+        return data
+    return data[:-TRAILER.size]
+
+class Tracer(object):
+    """
+    Opt-in tracing of the publish to handler path. A sample of the messages
+    published by the worker (sample_rate) get a trailer stamped when
+    published, encoded and written to the socket, and by the stand-in
+    broker. The receiving side strips it and records the time of each hop
+    in histograms. Probes are published on probe_topic every
+    probe_interval seconds and, with probe_subscribe, received back by the
+    same worker.
+
+    The clocks of publisher and subscriber hosts must be synchronized for
+    the cross host hops.
+    """
+
+    def __init__(self, reactor, config=None):
+        config = config or {}
+        self.reactor = reactor
+        self.sampleRate = config.get("sample_rate", 0.0)
+        self.probeTopic = config.get("probe_topic")
+        self.probeInterval = config.get("probe_interval", 1.0)
+        self.probeSubscribe = config.get("probe_subscribe", True)
+
+        self.nextId = 0
+        self.hops = dict((hop, Histogram()) for hop in HOPS)
+        self.traced = 0
+        self._probes = None
+
+    def start(self, message, force=False):
+        """
+        Returns message with a trailer if it is sampled.
+        """
+        if not force and (not self.sampleRate or random.random() >= self.sampleRate):
+            return message
+        if isinstance(message, type(u"")):
+            message = message.encode("utf-8")
+        self.nextId = (self.nextId + 1) & 0xFFFFFFFFFFFFFFFF
+        return message + TRAILER.pack(self.nextId, time.time(), 0, 0, 0, MAGIC)
+
+    def received(self, msg, readAt):
+        """
+        Strips the trailer of a received Publish and records the hops up to
+        its decoding. Returns the trace to give to handle(), None when the
+        message is not traced.
+        """
+        payload = msg.payload
+        if not payload.endswith(MAGIC) or len(payload) < TRAILER.size:
+            return None
+        now = time.time()
+        _id, publishedAt, encodedAt, sentAt, brokerAt, magic = \
+            TRAILER.unpack_from(payload, len(payload) - TRAILER.size)
+        msg.payload = payload[:-TRAILER.size]
+
+        self.traced += 1
+        self._record("encode", publishedAt, encodedAt)
+        self._record("queue", encodedAt, sentAt)
+        if brokerAt:
+            self._record("broker", sentAt, brokerAt)
+            self._record("network", brokerAt, readAt)
+        else:
+            self._record("network", sentAt, readAt)
+        self._record("decode", readAt, now)
+        return [publishedAt, now]
+
+    def handle(self, trace, function, payload):
+        publishedAt, decodedAt = trace
+        start = time.time()
+        try:
+            return function(payload)
+        finally:
+            end = time.time()
+            self._record("dispatch", decodedAt, start)
+            self._record("handler", start, end)
+            self._record("total", publishedAt, end)
+
+    def _record(self, hop, start, end):
+        if start and end:
+            self.hops[hop].record(max(end - start, 0))
+
+    # --------------------------------------------------------------------------
+    def startProbes(self, worker):
+        if not self.probeTopic:
+            return
+        if self.probeSubscribe:
+            worker.addTopic(self.probeTopic, self._probeReceived)
+        self._probes = LoopingCall(self._probe, worker)
+        self._probes.clock = self.reactor
+        self._probes.start(self.probeInterval, now=False)
+
+    def _probe(self, worker):
+        if worker.protocol is None or worker.protocol.state != worker.protocol.CONNECTED:
+            return
+        worker.protocol.publish(self.probeTopic, self.start(b"", force=True))
+
+    def _probeReceived(self, payload):
+        pass
+
+    def stop(self):
+        if self._probes is not None and self._probes.running:
+            self._probes.stop()
+        self._probes = None
+
+    def stats(self):
+        res = dict((hop, histogram.summary()) for hop, histogram in self.hops.items()
+                   if histogram.count)
+        res["traced"] = self.traced
+        return res
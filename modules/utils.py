@@ -22,6 +22,41 @@
 # SOFTWARE.
 ################################################################################
 
+import random
+
+class PacketIdSet(object):
+    """
+    Set of MQTT packet ids (1 to 65535) held in a 8 KB bitmap.
+    """
+    __slots__ = ("bits", "count")
+
+    def __init__(self):
+        self.bits = bytearray(8192)
+        self.count = 0
+
+    def add(self, _id):
+        """
+        Adds _id, returns False if it was already in the set.
+        """
+        mask = 1 << (_id & 7)
+        if self.bits[_id >> 3] & mask:
+            return False
+        self.bits[_id >> 3] |= mask
+        self.count += 1
+        return True
+
+    def discard(self, _id):
+        mask = 1 << (_id & 7)
+        if self.bits[_id >> 3] & mask:
+            self.bits[_id >> 3] &= ~mask & 0xFF
+            self.count -= 1
+
+    def __contains__(self, _id):
+        return bool(self.bits[_id >> 3] & (1 << (_id & 7)))
+
+    def __len__(self):
+        return self.count
+
 class IdGenerator(object):
     """
     ID generator for WAMP request IDs.
@@ -44,10 +79,133 @@ class IdGenerator(object):
         :rtype: int
         """
         self._next += 1
-        if self._next > 65536:
+        if self._next > 65535:
             self._next = 1
         return self._next
 
     # generator protocol
     def __next__(self):
         return self.next()
+
+def jitterBackoffPolicy(clock, initialDelay=1.0, maxDelay=60.0, factor=2.0,
+                        minInterval=0.0, random=random.random):
+    """
+    Retry policy for ClientService using capped exponential backoff with
+    full jitter: each delay is drawn uniformly from [0, min(maxDelay,
+    initialDelay * factor ** attempt)], so clients that lost the broker at the
+    same moment do not come back in lockstep.
+
+    minInterval rate limits connection attempts: two consecutive attempts are
+    never scheduled less than minInterval seconds apart.
+    """
+    lastAttempt = [None]
+
+    def policy(attempt):
+        try:
+            ceiling = min(initialDelay * (factor ** attempt), maxDelay)
+        except OverflowError:
+            ceiling = maxDelay
+        delay = random() * ceiling
+
+        if minInterval > 0:
+            now = clock.seconds()
+            if lastAttempt[0] is not None:
+                delay = max(delay, lastAttempt[0] + minInterval - now)
+            lastAttempt[0] = now + delay
+        return delay
+
+    return policy
+
+SHARED_PREFIX = "$share/"
+
+def sharedTopic(group, topicFilter):
+    """
+    Filter of a shared subscription: the broker delivers each message to
+    only one of the subscribers of the group.
+    """
+    return "%s%s/%s" %(SHARED_PREFIX, group, topicFilter)
+
+def splitShared(topicFilter):
+    """
+    Returns the group and filter of a shared subscription, None and the
+    filter itself otherwise.
+    """
+    if not topicFilter.startswith(SHARED_PREFIX):
+        return None, topicFilter
+    group, topicFilter = topicFilter[len(SHARED_PREFIX):].split("/", 1)
+    return group, topicFilter
+
+def isPattern(topicFilter):
+    """
+    Returns True if topicFilter can match other topics than itself: it has
+    a wildcard or is a shared subscription.
+    """
+    return ("+" in topicFilter or "#" in topicFilter
+            or topicFilter.startswith(SHARED_PREFIX))
+
+def topicMatches(topicFilter, topic):
+    """
+    Returns True if topic matches topicFilter, which may contain the '+'
+    (single level) and '#' (multi level) wildcards, or be a shared
+    subscription filter.
+    """
+    if topicFilter == topic:
+        return True
+
+    if topicFilter.startswith(SHARED_PREFIX):
+        topicFilter = splitShared(topicFilter)[1]
+        if topicFilter == topic:
+            return True
+
+    filterLevels = topicFilter.split("/")
+    topicLevels = topic.split("/")
+
+    # Wildcards do not match topics starting with $ (such as $SYS)
+    if topic.startswith("$") and filterLevels[0] in ("+", "#"):
+        return False
+
+    for i, level in enumerate(filterLevels):
+        if level == "#":
+            return True
+        if i >= len(topicLevels):
+            return False
+        if level != "+" and level != topicLevels[i]:
+            return False
+    return len(filterLevels) == len(topicLevels)
+
+class TokenBucket(object):
+    """
+    Token bucket allowing rate units per second with bursts of up to
+    capacity units (rate by default). A rate of 0 means unlimited.
+
+    An amount larger than the capacity is accepted once the bucket is full,
+    leaving it in debt, so that it can never be blocked forever.
+    """
+
+    def __init__(self, clock, rate, capacity=None):
+        self.clock = clock
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.last = clock.seconds()
+
+    def _refill(self):
+        now = self.clock.seconds()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def delay(self, amount=1):
+        """
+        Returns the number of seconds before amount can be consumed.
+        """
+        if not self.rate:
+            return 0
+        self._refill()
+        missing = min(amount, self.capacity) - self.tokens
+        if missing <= 0:
+            return 0
+        return missing / self.rate
+
+    def consume(self, amount=1):
+        if self.rate:
+            self.tokens -= amount
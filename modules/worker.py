@@ -22,93 +22,398 @@
 # SOFTWARE.
 ################################################################################
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from collections import deque
 
-from twisted.application.internet import ClientService, backoffPolicy
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, returnValue, CancelledError, succeed
+
+from twisted.application.internet import ClientService
 from twisted.internet.endpoints   import clientFromString
 from twisted.internet.protocol import Factory
 
-from protocol import MQTTProtocol
-from definitions import *
+from .protocol import MQTTProtocol
+from .definitions import *
+from .utils import jitterBackoffPolicy
+from .recorder import TrafficRecorder
+from .session import MQTTSession
+from .monitor import ReactorMonitor
+from .rpc import RPCClient, RPCServer
+from .batch import MessageBatcher
+from .tracing import Tracer
+from .threads import ThreadPublisher
+from .routing import Router
+from .filters import PreFilter
 
-class MQTTWorker(ClientService):
+class MQTTWorker(ClientService, MQTTSession):
 
     def __init__(self, reactor, config):
 
+        self.reactor = reactor
         self.endpoint = clientFromString(reactor, config["endpoint"])
+        # TLS over the endpoint, with session resumption and standby connection
+        self.tls = None
+        if config.get("tls"):
+            self.endpoint = self.tls = self._tlsEndpoint(reactor, config)
         self.factory = Factory.forProtocol(MQTTProtocol)
         self.version = VERSION[config["version"]]
         self.clientId = config["client_id"]
         self.username = config["username"]
         self.appKey = config["app_key"]
 
-        self.protocol = None
+        # With clean_start disabled the broker keeps our subscriptions and
+        # in flight messages across reconnections.
+        self.cleanStart = config.get("clean_start", True)
+
+        # Bigger incoming packets are refused before being buffered (0: no limit)
+        self.maxPacketSize = config.get("max_packet_size", 0)
+
+        # Binary log of the traffic, to be replayed with replay.py
+        self.recorder = None
+        if config.get("record_file"):
+            self.recorder = TrafficRecorder(config["record_file"])
+
+        # Priority classes and rate limits of the outbound traffic, see
+        # OutboundScheduler (None: packets are written in call order)
+        self.scheduling = config.get("scheduler")
+
+        # Reactor lag, dispatch and handler timings, runtime profiling
+        self.monitor = None
+        if config.get("monitor"):
+            self.monitor = ReactorMonitor(reactor, config["monitor"])
+
+        # Per hop latency of sampled messages and probes, see Tracer
+        self.tracer = None
+        if config.get("tracing"):
+            self.tracer = Tracer(reactor, config["tracing"])
+
+        # Request / response over a shared reply topic, created on first use
+        self.rpc = None
+        self.rpcReplyTopic = config.get("rpc_reply_topic")
+
+        # Publishes made while disconnected, sent once joined
+        self.offlineSize = config.get("offline_queue_size", 1000)
+        self.offline = deque()
+        # Map topic and its last conflated entry of the offline queue
+        self.offline_topics = {}
+
+        # Publishes handed over by other threads, see publishFromThread
+        self.threads = ThreadPublisher(self, reactor,
+                                       maxSize=config.get("thread_queue_size", 10000),
+                                       batchSize=config.get("thread_batch_size", 500))
+
+        self.initSession()
+
+        # Connections to other brokers carrying some topic prefixes, and
+        # bridges between them, see Router
+        self.router = None
+        if config.get("routes") or config.get("bridges"):
+            self.router = Router(self, reactor, config, MQTTWorker)
 
-        # In flight subscribe request
-        self.subscribe_requests = {}
+        retryPolicy = jitterBackoffPolicy(reactor,
+                                          initialDelay=config.get("reconnect_initial_delay", 1.0),
+                                          maxDelay=config.get("reconnect_max_delay", 60.0),
+                                          factor=config.get("reconnect_factor", 2.0),
+                                          minInterval=config.get("connect_min_interval", 0.0))
 
-        # Map topic and related function
-        self.topics = {}
+        if self.tls is not None and self.tls.standby:
+            # Takes over at once when a standby connection is ready
+            backoff = retryPolicy
+            retryPolicy = lambda attempt: 0 if self.tls.standbyReady() else backoff(attempt)
 
-        # Map of publish waiting for ack
-        self.publish_requests = {}
+        ClientService.__init__(self, self.endpoint, self.factory, retryPolicy=retryPolicy)
 
-        ClientService.__init__(self, self.endpoint, self.factory, retryPolicy=backoffPolicy())
+    def _tlsEndpoint(self, reactor, config):
+        # pyOpenSSL is only required for TLS brokers
+        from .tls import TLSClientEndpoint, tlsOptions
+
+        tls = config["tls"]
+        hostname = tls.get("hostname") or config["endpoint"].split(":")[1]
+        return TLSClientEndpoint(reactor, self.endpoint, tlsOptions(hostname, tls),
+                                 reuse=tls.get("session_reuse", True),
+                                 standby=tls.get("standby", False),
+                                 standbyDelay=tls.get("standby_delay", 1.0))
 
     def start(self):
         print("INFO: Starting MQTT Client")
 
-        self.whenConnected().addCallback(self.connected)
+        self._waitConnection()
+        self.threads.start()
+        if self.monitor is not None:
+            self.monitor.start()
+        if self.tracer is not None:
+            self.tracer.startProbes(self)
+        if self.router is not None:
+            self.router.start()
         self.startService()
 
+    def _waitConnection(self):
+        d = self.whenConnected()
+        d.addCallback(self.connected)
+        # Pending waits are cancelled when the service stops
+        d.addErrback(lambda failure: failure.trap(CancelledError))
+
     def connected(self, protocol):
         print("INFO: Client Connected")
         self.protocol = protocol
         protocol.connect(self)
 
-    def joined(self):
-        print("INFO: MQTT joined")
+    def stopService(self):
+        d = ClientService.stopService(self)
+        if self.tls is not None:
+            self.tls.stop()
+        if self.monitor is not None:
+            self.monitor.stop()
+        if self.tracer is not None:
+            self.tracer.stop()
+        self.threads.stop()
+        if self.router is not None:
+            d = DeferredList([d] + self.router.stop(), consumeErrors=True)
+        if self.rpc is not None:
+            self.rpc.stop()
+        if self.batches:
+            for batcher in self.batches.values():
+                batcher.flush()
+        if self.recorder:
+            d.addBoth(self._closeRecorder)
+        return d
+
+    def _closeRecorder(self, result):
+        self.recorder.close()
+        return result
+
+    def disconnected(self, protocol, reason):
+        print("INFO: Client Disconnected")
+        if self.recorder:
+            self.recorder.flush()
+        if self.protocol is protocol:
+            self.protocol = None
+        # ClientService learns about the loss after the protocol: waiting now
+        # would give back this same protocol
+        self.reactor.callLater(0, self._rewaitConnection)
+
+    def _rewaitConnection(self):
+        if self.running:
+            self._waitConnection()
+
+    def joined(self, sessionPresent=False):
+        print("INFO: MQTT joined (session present: %s)" %(sessionPresent))
+        MQTTSession.joined(self, sessionPresent)
+        if self.rpc is not None:
+            self.rpc.joined(sessionPresent)
+        self._flushOffline()
+
+    def _flushOffline(self):
+        offline, self.offline = self.offline, deque()
+        self.offline_topics.clear()
+        for topic, message, qos, priority, conflate, d in offline:
+            self.protocol.publish(topic, message, qos, priority=priority,
+                                  conflate=conflate).chainDeferred(d)
+
+    def subscribe(self, topic, function, qos=None):
+        """
+        Subscribes function to topic on the connection routing it. Without
+        qos, the one of the route.
+        """
+        if self.router is not None:
+            return self.router.route(topic).subscribe(topic, function, qos)
+        return self._subscribe(topic, function, qos or 0)
 
     @inlineCallbacks
-    def subscribe(self, topic, function, qos=0):
+    def _subscribe(self, topic, function, qos=0):
         yield self.protocol.subscribe(topic, function, qos)
 
+    def subscribeBatch(self, topicFilter, handler, maxMessages=1000, maxDelay=0.05,
+                       layout=None, qos=0):
+        """
+        Subscribes to topicFilter, calling handler once per batch of up to
+        maxMessages messages or every maxDelay seconds. See MessageBatcher
+        for the batch and the NumPy layout. While disconnected, the filter is
+        subscribed once joined.
+        """
+        worker = self._routed(topicFilter)
+        batcher = MessageBatcher(self.reactor, handler, maxMessages, maxDelay, layout)
+        if worker.protocol is None:
+            worker.addBatch(topicFilter, batcher, qos)
+            return succeed(None)
+        return worker.protocol.subscribeBatch(topicFilter, batcher, qos)
+
+    def unsubscribeBatch(self, topicFilter):
+        worker = self._routed(topicFilter)
+        if worker.protocol is None:
+            worker.removeBatch(topicFilter)
+            return succeed(None)
+        return worker.protocol.unsubscribeBatch(topicFilter)
+
+    def unsubscribe(self, topic, function=None):
+        return self.unsubscribeMany([(topic, function)])
+
+    def unsubscribeMany(self, handlers):
+        """
+        Removes (topic, function) handlers, the broker subscription of a
+        topic being released with its last handler.
+        """
+        if self.router is not None:
+            return self.router.unsubscribeMany(handlers)
+        return self._unsubscribeMany(handlers)
+
+    def _unsubscribeMany(self, handlers):
+        if self.protocol is None:
+            for topic, function in handlers:
+                self.removeTopic(topic, function)
+            return succeed(None)
+        return self.protocol.unsubscribeMany(handlers)
+
+    def filterTopic(self, topicFilter, segments=None, predicate=None, busyBytes=0,
+                    rate=0, sample=0):
+        """
+        Filters the messages received on topicFilter from their topic before
+        they are decoded, see PreFilter. Returns the PreFilter.
+        """
+        prefilter = PreFilter(self.reactor, segments, predicate, busyBytes, rate, sample)
+        self._routed(topicFilter).addFilter(topicFilter, prefilter)
+        return prefilter
+
+    def publish(self, topic, message, qos=None, priority=None, conflate=False):
+        """
+        Publishes message on topic, or queues it until joined when
+        disconnected. With conflate, only the latest value of a topic is kept
+        while messages wait to be written. Without qos, the one of the route
+        of topic (0 without routes).
+        """
+        if self.router is not None:
+            return self.router.route(topic).publish(topic, message, qos, priority, conflate)
+        return self._publish(topic, message, qos or 0, priority, conflate)
+
+    def _publish(self, topic, message, qos=0, priority=None, conflate=False):
+        if self.tracer is not None:
+            message = self.tracer.start(message)
+        if self.protocol is not None and self.protocol.state == MQTTProtocol.CONNECTED:
+            return self.protocol.publish(topic, message, qos, priority=priority,
+                                         conflate=conflate)
+
+        if conflate:
+            entry = self.offline_topics.get(topic)
+            if entry is not None:
+                entry[1] = message
+                # The merged message is sent with the highest QoS asked
+                entry[2] = max(entry[2], qos)
+                self.conflated += 1
+                res = Deferred()
+                def chain(result):
+                    res.callback(result)
+                    return result
+                entry[5].addCallback(chain)
+                return res
+
+        d = Deferred()
+        if len(self.offline) >= self.offlineSize:
+            d.errback(Exception("Offline queue full"))
+            return d
+
+        entry = [topic, message, qos, priority, conflate, d]
+        self.offline.append(entry)
+        if conflate:
+            self.offline_topics[topic] = entry
+        return d
+
+    def publishFromThread(self, topic, message, qos=None, priority=None, conflate=False,
+                          block=True, timeout=None):
+        """
+        Thread safe publish. Returns a PublishFuture set once the message is
+        sent (QoS 0) or acknowledged (QoS 1/2). When the hand over queue is
+        full the thread waits up to timeout seconds for room with block,
+        otherwise the future fails at once.
+        """
+        return self.threads.publish(topic, message, qos, priority, conflate, block, timeout)
+
+    def request(self, topic, payload, timeout=10.0, qos=0):
+        """
+        Sends a request to the RPCServer serving topic. Returns a Deferred
+        firing with the response payload, failing with RPCError when the
+        handler failed or RPCTimeout after timeout seconds.
+        """
+        if self.rpc is None:
+            self.rpc = RPCClient(self, self.reactor, self.rpcReplyTopic)
+        return self.rpc.request(topic, payload, timeout, qos)
+
+    def serve(self, topic, handler, qos=0):
+        """
+        Answers the requests published on topic with handler(payload), which
+        returns the response payload or a Deferred of it.
+        """
+        return self.subscribe(topic, RPCServer(self, handler, qos).handleRequest, qos)
+
     @inlineCallbacks
-    def publish(self, topic, message, qos=0):
-        yield self.protocol.publish(topic, message, qos)
-
-    def addSubscribeRequest(self, request, d):
-        # XXX To Do: Add boolean to know if a timer should be start
-        if not request._id in self.subscribe_requests:
-            self.subscribe_requests[request._id] = d
-
-    def getSubscribeRequest(self, _id, remove=False):
-        res = None
-        if _id in self.subscribe_requests:
-            res = self.subscribe_requests[_id]
-            if remove:
-                del self.subscribe_requests[_id]
-        return res
-
-    def addTopic(self, topic, function):
-        if not topic in self.topics:
-            self.topics[topic] = function
-
-    def getTopic(self, topic):
-        res = None
-        if topic in self.topics:
-            res = self.topics[topic]
-        return res
-
-    def addPublishRequest(self, request, d):
-        # XXX To Do: Add boolean to know if a timer should be start
-        if not request._id in self.publish_requests:
-            self.publish_requests[request._id] = d
-
-    def getPublishRequest(self, _id, remove=False):
-        res = None
-        if _id in self.publish_requests:
-            res = self.publish_requests[_id]
-            if remove:
-                del self.publish_requests[_id]
-        return res
+    def subscribeStream(self, topic, factory, qos=0):
+        yield self._routed(topic).protocol.subscribeStream(topic, factory, qos)
+
+    @inlineCallbacks
+    def publishStream(self, topic, body, qos=0, retain=False):
+        yield self._routed(topic).protocol.publishStream(topic, body, qos, retain)
+
+    def _routed(self, topic):
+        """
+        Worker of the connection carrying topic: this one without routes
+        or for the default route.
+        """
+        if self.router is None:
+            return self
+        return self.router.route(topic).worker
+
+    def schedulerStats(self):
+        """
+        Queue depth and wait time per priority class of the current
+        connection, None without scheduler.
+        """
+        if self.protocol is None or self.protocol.scheduler is None:
+            return None
+        return self.protocol.scheduler.stats()
+
+    def tlsStats(self):
+        """
+        Handshake times, resumed sessions and standby takeovers, None without
+        TLS.
+        """
+        if self.tls is None:
+            return None
+        return self.tls.stats()
+
+    def monitorStats(self):
+        """
+        Reactor lag, dispatch and handler timings and the slow calls, None
+        without monitor.
+        """
+        if self.monitor is None:
+            return None
+        return self.monitor.stats()
+
+    def traceStats(self):
+        """
+        Latency per hop of the traced messages, None without tracing.
+        """
+        if self.tracer is None:
+            return None
+        return self.tracer.stats()
+
+    def threadStats(self):
+        """
+        Publishes waiting in the thread hand over queue, published and
+        reactor wakeups.
+        """
+        return self.threads.stats()
+
+    def routeStats(self):
+        """
+        Published, received and bridged messages per route, with their rates
+        over the last route_stats_interval seconds. None without routes.
+        """
+        if self.router is None:
+            return None
+        return self.router.stats()
+
+    def filterStats(self):
+        """
+        Messages checked, delivered and dropped per reason for each pre-filtered
+        topic filter.
+        """
+        return dict((topicFilter, prefilter.stats())
+                    for topicFilter, prefilter in (self.filters or {}).items())
@@ -0,0 +1,86 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import argparse
+import os
+import sys
+
+from twisted.internet import reactor
+
+from modules.worker import MQTTWorker
+from modules.protocol import MQTTProtocol
+from modules.recorder import Replayer, NullTransport
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Replays the inbound traffic of "
+                                     "a record file into an offline MQTT client.")
+    parser.add_argument("file", help="record file written with the record_file option")
+    parser.add_argument("--speed", type=float, default=0,
+                        help="1: original speed, N: N times faster, 0: as fast as possible")
+    parser.add_argument("--topic", action="append", default=[],
+                        help="topic to dispatch to a no-op handler (repeatable)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="keep the protocol debug output")
+    args = parser.parse_args()
+
+    config = {
+      "endpoint": "tcp:localhost:1883",
+      "version": "v311",
+      "client_id": "replay",
+      "username": None,
+      "app_key": None
+    }
+
+    worker = MQTTWorker(reactor, config)
+    protocol = MQTTProtocol()
+    protocol.makeConnection(NullTransport())
+    worker.connected(protocol)
+
+    received = [0]
+    def handler(payload):
+        received[0] += 1
+    for topic in args.topic:
+        worker.addTopic(topic, handler)
+
+    # Debug prints would dominate the measure
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    def report(stats):
+        sys.stdout = stdout
+        print("INFO: Replayed %(chunks)d chunks, %(bytes)d bytes, %(packets)d packets "
+              "in %(elapsed).3fs" %stats)
+        print("INFO: %(packets_per_second).0f packets/s, %(megabytes_per_second).2f MB/s" %stats)
+        print("INFO: %d messages dispatched to handlers" %(received[0]))
+
+    replayer = Replayer(args.file, protocol, speed=args.speed)
+    d = replayer.run(reactor)
+    d.addCallback(report)
+
+    if args.speed:
+        d.addBoth(lambda _: reactor.stop())
+        reactor.run()
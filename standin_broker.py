@@ -0,0 +1,60 @@
+################################################################################
+# MIT License
+#
+# Copyright (c) 2017 Jean-Charles Fosse & Johann Bigler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+################################################################################
+
+import argparse
+import os
+import sys
+
+from twisted.internet import reactor
+
+from modules.broker import listen
+
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Runs the stand-in MQTT broker.")
+    parser.add_argument("endpoint", nargs="?", default="tcp:1883:interface=127.0.0.1",
+                        help="server endpoint description")
+    parser.add_argument("--tls-cert", help="PEM certificate, serves TLS over the endpoint")
+    parser.add_argument("--tls-key", help="PEM private key of the certificate")
+    parser.add_argument("--verbose", action="store_true", help="keep the debug output")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+
+    def started(result):
+        port, factory = result
+        sys.stderr.write("INFO: Stand-in broker listening on %s\n" %(args.endpoint))
+
+    def failed(failure):
+        sys.stderr.write("ERROR: %s\n" %(failure.getErrorMessage()))
+        reactor.stop()
+
+    tls = None
+    if args.tls_cert:
+        tls = {"cert_file": args.tls_cert, "key_file": args.tls_key}
+
+    reactor.callWhenRunning(lambda: listen(reactor, args.endpoint, tls).addCallbacks(started, failed))
+    reactor.run()
@@ -46,7 +46,24 @@ if __name__ == '__main__':
       "version": "v311",
       "client_id": "____",
       "username": "____",
-      "app_key": "____"
+      "app_key": "____",
+      "clean_start": True,
+      "reconnect_initial_delay": 1.0,
+      "reconnect_max_delay": 60.0,
+      "connect_min_interval": 0.0,
+      "max_packet_size": 0,
+      "record_file": None,
+      "scheduler": None,
+      "offline_queue_size": 1000,
+      "tls": None,
+      "monitor": None,
+      "rpc_reply_topic": None,
+      "tracing": None,
+      "thread_queue_size": 10000,
+      "thread_batch_size": 500,
+      "routes": None,
+      "bridges": None,
+      "route_stats_interval": 1.0
     }
 
     # Worker managing the router. It is a Singleton